@@ -54,6 +54,13 @@ myecho () {
     echo "$1"
 }
 
+%(copy_tree)s
+# state of the job (see JOB_STATE in csub), next to the tarball on shared storage: checkpoint count (chkpt),
+# number of failed restarts (restarts) and starts (starts), PID of checkpointed process (pid), checkpoint requested by
+# user (user_kill), end of job (end: normal or complete), whether the tarball is complete (tarball: ok), and with
+# --profile the peak resource usage (peak_rss, peak_vsz, peak_procs) and checkpoint rate in bytes/second (chkpt_rate)
+chkstate="${%(CSUB_SCRATCH)s}/chkpt/$jobname/%(chkptsubdir)s/chkpt.state"
+%(job_state)s
 if [ -z "${%(CSUB_SCRATCH_NODE)s}" ]
 then
     echo "%(CSUB_SCRATCH_NODE)s undefined"
@@ -61,6 +68,19 @@ then
     exit 1
 fi
 
+# with --prequeue, the next job may still start after the job ended without being checkpointed (if it could not
+# be cancelled); there is nothing left to do then
+if (( %(prequeue)d ))
+then
+    laststate=`awk -v name=$jobname '$3 == name { state = $4 } END { print state }' "${%(CSUB_SCRATCH)s}/chkpt/.index" 2> /dev/null`
+    case "$laststate" in
+        complete|failed|killed|removed)
+            myecho "Job $jobname already ended (state: $laststate), nothing to do."
+            exit 0
+            ;;
+    esac
+fi
+
 %(prologue)s ${%(CSUB_JOBID)s} "" "" ${%(CSUB_JOBNAME)s} %(cleanup_chkpt)d
 
 if [ $? -ne 0 ]
@@ -69,22 +89,27 @@ then
 	exit 2
 fi
 
+shared_workdir=0
 if [ ! -d "$localdir" ]
 then
     ## no result from prologue -> shared checkpoint dir
     myecho "No localdir $localdir found (No local checkpoint)"
+    shared_workdir=1
 
     localdir=${%(CSUB_SCRATCH)s}/chkpt/$jobname
 
     # this directory should be created by csub
-    if [ ! -d "$localdir" ]
+    # (with --auto_storage, prologue may have created it for an array task, only to record its choice)
+    if [ ! -f "$localdir/$scriptname" ]
     then
     	## initial array job?
     	localdir_initial=${%(CSUB_SCRATCH)s}/chkpt/$jobname_stripped
-    	if [ ! -f "$localdir/%(chkptsubdir)s/chkpt.count" ] && [ -d "$localdir_initial" ]
+    	if [ -z "`state_get "$chkstate" chkpt`" ] && [ -d "$localdir_initial" ] && [ "$localdir_initial" != "$localdir" ]
     	then
     		# copy initial job directory for array jobs
-    		cp -r "$localdir_initial" "$localdir"
+    		copy_tree "$localdir_initial" "$localdir"
+    		# initial tarball (and its state) is of no use in a shared job dir
+    		rm -f "$localdir/%(chkptsubdir)s/job.localdir.tarball"* "$chkstate"*
     	else
         	## problem
         	myecho "No localdir $localdir found (No shared checkpoint)"
@@ -97,21 +122,55 @@ else
 fi
 
 chkdir="$localdir/%(chkptsubdir)s"
-mkdir -p "$chkdir/"
+mkdir -p "$chkdir/" "`dirname $chkstate`"
+
+# directory for checkpoint images
+# with --auto_storage and a node-local job dir, this is a symlink that is pointed to node-local storage
+# ($chkdir/images.local, packed in tarball by epilogue) or shared storage ($chkimgshared) right before
+# every checkpoint, depending on the expected size of the images (see choose_image_dir)
+auto_storage=%(auto_storage)d
+# expected size of checkpoint images (bytes) before the first checkpoint
+image_estimate=%(image_estimate)d
+%(storage_space)s
+chkimgdir="$chkdir"
+chkimgshared="$%(CSUB_SCRATCH)s/chkpt/$jobname/%(chkptsubdir)s/images"
+auto_images=0
+if (( $auto_storage )) && (( ! $shared_workdir ))
+then
+    auto_images=1
+    chkimgdir="$chkdir/images"
+    if [ ! -L "$chkimgdir" ]
+    then
+        mkdir -p "$chkdir/images.local"
+        ln -s images.local "$chkimgdir"
+    fi
+fi
+
+# with --mpi, processes on all nodes of the job share one DMTCP coordinator (on this node), every node writes the
+# checkpoint images of its processes to node-local storage (same path on all nodes), after a checkpoint they are
+# collected in shared storage ($chkhostimages, one tarball per node, see gather_images) and they are distributed
+# over the nodes of the new job before a restart (see scatter_images)
+mpi=%(mpi)d
+chkhostimages="$chkdir/hostimages"
+# remote shell to run commands on other nodes of the job
+CSUB_RSH=${CSUB_RSH:-ssh}
+# number of processes that must be connected to the coordinator for a (re)start to be complete
+expected_peers=1
+if (( $mpi ))
+then
+    chkimgdir="${%(CSUB_SCRATCH_NODE)s}/$jobname.images"
+    mkdir -p "$chkimgdir"
+fi
 
 chktarb="$%(CSUB_SCRATCH)s/chkpt/$jobname/%(chkptsubdir)s/job.localdir.tarball"
 chklock="$chkdir/chkpt.lock"
-chkstat="$chkdir/chkpt.status"
-chkid="$chkdir/chkpt.count"
 
 # set environment variable with location of checkpoint file
 # can be used by user program to checkpoint itself
 export CSUB_CHECKPOINT_DIR="$chkdir"
-export CSUB_CHECKPOINT_FILE=`ls $chkdir/*.dmtcp 2> /dev/null`
-# initialize env variable for PID of process to be checkpointed
-export CSUB_MASTER_PID_FILE="$chkdir/csub_master_pid"
-# file to be touched/written if user kills the process
-export CSUB_KILL_ACK_FILE="$chkdir/script_killed_by_user"
+export CSUB_CHECKPOINT_FILE=`ls $chkimgdir/*.dmtcp 2> /dev/null`
+# job state, with PID of process to be checkpointed (pid), to be updated (user_kill=1) if user kills the process
+export CSUB_STATE_FILE="$chkstate"
 # script to be used by user to checkpoint
 export CSUB_USER_CHKPT_SCRIPT="$chkdir/%(user_chkpt_script_file)s"
 
@@ -119,26 +178,540 @@ jobout="$localdir/$jobname.out"
 joberr="$localdir/$jobname.err"
 
 chkreout="$chkdir/chkpt.restart.out"
-chkrecount="$chkdir/chkpt.restart.count"
-chkrestat="$chkdir/chkpt.restart.status"
 crcountmax=10
+# delay (seconds) before retrying a failed restart, doubled for every next attempt, at most $chkretry_max
+chkretry_delay=5
+chkretry_max=300
+# nodes on which a restart failed, excluded when resubmitting (on shared storage, next to the tarball)
+chkfailednodes="$%(CSUB_SCRATCH)s/chkpt/$jobname/%(chkptsubdir)s/chkpt.failed_nodes"
+# with --lazy_restore, files needed right after a restart (hot set, see record_hot_set) are packed with the checkpoint
+# images by the epilogue, and the prologue extracts all other files in the background while the job is restarted;
+# $chkrestoring exists until that is done (see restore_cold in epilogue)
+lazy_restore=%(lazy_restore)d
+chkhotset="$chkdir/chkpt.hotset"
+chkrestoring="$chkdir/chkpt.restoring"
+# with --prequeue, the next job is submitted as soon as the job has (re)started (see prequeue), its job id is kept
+# here (on shared storage) until it is handed over in resubmit, or cancelled when the job ends otherwise
+prequeue=%(prequeue)d
+chknextjob="$%(CSUB_SCRATCH)s/chkpt/$jobname/%(chkptsubdir)s/chkpt.next"
+# checksums of checkpoint images (md5sum format), recorded after every checkpoint, next to the images
+IMAGESUMS=images.md5
+# max. time (seconds) to wait for DMTCP coordinator/process to be ready after (re)start
+chkready_timeout=120
 
-startcount="$chkdir/start.count"
 stcountmax=5
 
-chkslint=60
 chksltot=%(job_time)d
 
+# history of checkpoint durations (makechkpt in base, pack in epilogue), one line per phase per job:
+# <job id> <phase> <seconds>
+# kept next to the tarball, so it is available for all subsequent jobs
+chkhist="$%(CSUB_SCRATCH)s/chkpt/$jobname/%(chkptsubdir)s/chkpt.durations"
+# index of all csub jobs, one line per state transition (see csub --status):
+# <timestamp> <job id> <job name> <state> <checkpoint count>
+chkindex="$%(CSUB_SCRATCH)s/chkpt/.index"
+# timing of all phases of the job, one JSON object per line (see csub --report)
+chkmetrics="$%(CSUB_SCRATCH)s/chkpt/.metrics/$jobname.jsonl"
+# size walltime of resubmitted job according to checkpoint duration history
+adaptive_chkpt_time=%(adaptive_chkpt_time)d
+
+# periodic checkpoints during the job, at optimal interval for given MTBF (0: only checkpoint at end)
+chkpt_mtbf=%(chkpt_mtbf)d
+# number of checkpoint generations to keep (on shared storage, so they survive a node crash)
+chkpt_generations=%(chkpt_generations)d
+chkgendir="$%(CSUB_SCRATCH)s/chkpt/$jobname/%(chkptsubdir)s/generations"
+
+# sample resource usage of the checkpointed processes every $profile_interval seconds while sleeping (0: don't),
+# one line per sample: <job id> <timestamp> <rss> <vsz> <cpu seconds> <bytes read> <bytes written> <processes>
+# (peaks are kept in the job state: peak_rss, peak_vsz, peak_procs)
+profile_interval=%(profile_interval)d
+chkprofile="$%(CSUB_SCRATCH)s/chkpt/$jobname/%(chkptsubdir)s/chkpt.profile"
+# request virtual memory for the next job based on the peak virtual memory use, plus a margin of $vmem_margin %%
+auto_vmem=%(auto_vmem)d
+vmem_margin=%(vmem_margin)d
+# initial estimate of checkpoint cost (seconds), updated after every periodic checkpoint
+chkpt_cost=`awk '$2 == "makechkpt" { t += $3; n++ } END { print (n ? int(t / n) : 60) }' "$chkhist" 2> /dev/null`
+chkpt_cost=${chkpt_cost:-60}
+
+# signals from the scheduler (advance warning before the wall time is up, preemption) that trigger
+# an immediate checkpoint and resubmit, rather than waiting until the sleep budget is used up
+chkpt_signals="%(chkpt_signals)s"
+chkpt_signalled=0
+# schedulers send a preemption signal to all processes of the job, so the checkpointed process
+# gets its own session to make sure it is still around to be checkpointed
+DMTCP_SESSION=""
+if [ -n "$chkpt_signals" ]
+then
+    DMTCP_SESSION=setsid
+fi
+
 chkprestage="$chkdir/prestage"
 chkpoststage="$chkdir/poststage"
 
+record_duration () {
+    mkdir -p "`dirname $chkhist`"
+    echo "$%(CSUB_JOBID)s $1 $2" >> "$chkhist"
+}
+
+# checkpoint count of job (0 if not started yet)
+chkpt_count () {
+    count=`state_get "$chkstate" chkpt`
+    echo ${count:-0}
+}
+
+# add state transition $1 to index, for job id $2 (default: this job; the next job for 'resubmitted')
+index_state () {
+    local indexid=(${2:-$%(CSUB_JOBID)s})
+    echo "`date +%%s` $indexid $jobname $1 `chkpt_count`" >> "$chkindex"
+}
+
+# add timing event for phase $1 that started at $2 (and ends now), $3 is number of bytes written (if any)
+metrics_event () {
+    mkdir -p "`dirname $chkmetrics`"
+    printf '{"jobid": "%%s", "cycle": %%d, "phase": "%%s", "start": %%d, "end": %%d, "bytes": %%d}\\n' \
+        $%(CSUB_JOBID)s `chkpt_count` $1 $2 `date +%%s` ${3:-0} >> "$chkmetrics"
+}
+
+chkpt_budget () {
+    # predict time required for checkpointing (seconds) from the history of the last 5 jobs:
+    # largest total duration of makechkpt and pack, plus a safety margin of 50%% and 1 minute
+    # with --profile, at least the time to write images of the peak memory use at the measured checkpoint rate
+    mem_time=0
+    peak=`state_get "$chkstate" peak_rss`
+    rate=`state_get "$chkstate" chkpt_rate`
+    if [ -n "$peak" ] && [ ${rate:-0} -gt 0 ]
+    then
+        mem_time=$(($peak / $rate))
+    fi
+    if [ -f "$chkhist" ]
+    then
+        awk -v mem=$mem_time '{
+            if (!($1 in total)) {
+                jobs[n++] = $1
+            }
+            total[$1] += $3
+        }
+        END {
+            if (n == 0) {
+                exit
+            }
+            max = mem
+            for (i = (n > 5 ? n - 5 : 0); i < n; i++) {
+                if (total[jobs[i]] > max) {
+                    max = total[jobs[i]]
+                }
+            }
+            print int(max * 1.5) + 60
+        }' "$chkhist"
+    fi
+}
+
+# wait until file $1 exists and is not empty, at most $chkready_timeout seconds
+wait_for_file () {
+    deadline=$((`date +%%s` + $chkready_timeout))
+    until [ -s "$1" ]
+    do
+        if [ `date +%%s` -ge $deadline ]
+        then
+            myecho "File $1 not found after $chkready_timeout seconds"
+            return 1
+        fi
+        sleep 0.1
+    done
+}
+
+# wait until DMTCP coordinator reports that the checkpointed process ($1, dmtcp_launch or dmtcp_restart)
+# is running (with at least $expected_peers processes connected), at most $chkready_timeout seconds
+# returns 1 if the process exits or does not get running in time
+wait_until_running () {
+    deadline=$((`date +%%s` + $chkready_timeout))
+    while kill -0 $1 2> /dev/null
+    do
+        if [ -s "$chkdir/$PORTFILE" ] && \
+            $DMTCP_COMMAND --port `cat "$chkdir/$PORTFILE"` --status 2> /dev/null | \
+            awk -F= -v n=$expected_peers '$1 ~ /NUM_PEERS/ { p = $2 } $1 ~ /RUNNING/ { r = $2 } END { exit !(r == "yes" && (p == "" || p >= n)) }'
+        then
+            return 0
+        fi
+        if [ `date +%%s` -ge $deadline ]
+        then
+            myecho "Process $1 not running after $chkready_timeout seconds"
+            return 1
+        fi
+        sleep 0.1
+    done
+    myecho "Process $1 exited"
+    return 1
+}
+
+# find current checkpoint images, with extra find arguments $@
+# (with --mpi, also the tarballs of images collected from all nodes)
+find_images () {
+    if (( $mpi ))
+    then
+        find $chkimgdir/ $chkhostimages/ -maxdepth 1 \( -name '*.dmtcp' -o -name '*.tar' \) "$@" 2> /dev/null
+    else
+        find $chkimgdir/ -maxdepth 1 -name '*.dmtcp' "$@"
+    fi
+}
+
 timestamp_latest_checkpoint() {
     # determine timestamp of most recent checkpoint (0 if no checkpoint files are found)
     # note: percent and newline must be escaped since this script is templated by Python!
-    timestamp=`find $chkdir -maxdepth 1 -name '*.dmtcp' -printf '%%T@\\n' | sort -n | tail -1 | cut -f1 -d.`
+    timestamp=`find_images -printf '%%T@\\n' | sort -n | tail -1 | cut -f1 -d.`
     echo ${timestamp:-0}
 }
 
+# total size (bytes) of current checkpoint images
+image_bytes () {
+    find_images -printf '%%s\\n' | awk '{ s += $1 } END { print s + 0 }'
+}
+
+# record checksums of current checkpoint images in $chkimgdir/$IMAGESUMS (images are read in parallel,
+# right after they were written)
+record_image_sums () {
+    (
+        cd $chkimgdir/ || exit 1
+        ls | grep '[.]dmtcp$' | xargs -r -n 1 -P 4 md5sum > "$IMAGESUMS.tmp" && mv "$IMAGESUMS.tmp" "$IMAGESUMS"
+    )
+}
+
+# check checkpoint image $2 in directory $1: not empty, valid header (DMTCP image, gzip compressed DMTCP image
+# or tarball of images with --mpi), and checksum recorded in $1/$IMAGESUMS (if any)
+check_image () {
+    img="$1/$2"
+    if [ ! -s "$img" ]
+    then
+        myecho "Checkpoint image $img is empty or missing"
+        return 1
+    fi
+    case "$2" in
+        *.tar)
+            magic=`head -c 262 "$img" | tail -c 5`
+            ;;
+        *)
+            magic=`head -c 22 "$img"`
+            if [ "`head -c 2 "$img" | od -A n -t x1 | tr -d ' '`" == "1f8b" ]
+            then
+                magic=DMTCP_CHECKPOINT_IMAGE
+            fi
+            ;;
+    esac
+    if [ "$magic" != "DMTCP_CHECKPOINT_IMAGE" ] && [ "$magic" != "ustar" ]
+    then
+        myecho "Checkpoint image $img has no valid header"
+        return 1
+    fi
+    expected=`awk -v f="$2" '$2 == f { print $1 }' "$1/$IMAGESUMS" 2> /dev/null`
+    if [ -n "$expected" ] && [ "`md5sum < "$img" | cut -d' ' -f1`" != "$expected" ]
+    then
+        myecho "Checksum of checkpoint image $img does not match"
+        return 1
+    fi
+}
+
+# check all checkpoint images in directory $1 in parallel (see check_image), returns 1 if there are none
+# or any of them is not valid
+validate_images () {
+    imgs=`ls "$1" 2> /dev/null | grep '[.]\(dmtcp\|tar\)$'`
+    if [ -z "$imgs" ]
+    then
+        return 1
+    fi
+    pids=""
+    for img in $imgs
+    do
+        check_image "$1" $img &
+        pids="$pids $!"
+    done
+    ec=0
+    for pid in $pids
+    do
+        wait $pid || ec=1
+    done
+    return $ec
+}
+
+# directories with a set of checkpoint images, newest first: images of the last checkpoint (collected images
+# of all nodes with --mpi), and periodic checkpoint generations
+image_sets () {
+    if (( $mpi ))
+    then
+        echo "$chkhostimages"
+        return 0
+    fi
+    (
+        echo "`timestamp_latest_checkpoint` $chkimgdir"
+        if [ -d "$chkgendir" ]
+        then
+            ls "$chkgendir" | grep -v tmp | sed "s@.*@& $chkgendir/&@"
+        fi
+    ) | sort -r -n | cut -d' ' -f2
+}
+
+# delay (seconds) before restart attempt $1: exponential backoff
+restart_delay () {
+    delay=$(($chkretry_delay << ($1 - 1)))
+    if [ $delay -gt $chkretry_max ] || [ $delay -le 0 ]
+    then
+        delay=$chkretry_max
+    fi
+    echo $delay
+}
+
+# nodes of the job: this node first, then the other nodes in the node file of the scheduler (if any)
+job_hosts () {
+    hostname
+    if [ -n "$%(CSUB_NODEFILE)s" ] && [ -f "$%(CSUB_NODEFILE)s" ]
+    then
+        awk -v me=`hostname -s` '{ h = $1; sub(/[.].*/, "", h) } h != me && !seen[$1]++ { print $1 }' "$%(CSUB_NODEFILE)s"
+    fi
+}
+
+# run command $2 on node $1
+on_host () {
+    if [ "$1" == "`hostname`" ]
+    then
+        bash -c "$2"
+    else
+        $CSUB_RSH "$1" "$2"
+    fi
+}
+
+# run command $1 on all nodes of the job in parallel, returns 1 if it failed on any of them
+on_all_hosts () {
+    pids=""
+    for host in `job_hosts`
+    do
+        on_host $host "$1" &
+        pids="$pids $!"
+    done
+    ec=0
+    for pid in $pids
+    do
+        wait $pid || ec=1
+    done
+    return $ec
+}
+
+# collect the checkpoint images of all nodes in shared storage, one tarball per node (written in parallel)
+# previous set of tarballs is replaced once all nodes are done, images are then removed from node-local storage
+gather_images () {
+    hosts=`job_hosts`
+    rm -Rf "$chkhostimages.tmp"
+    mkdir -p "$chkhostimages.tmp"
+    pids=""
+    i=0
+    for host in $hosts
+    do
+        # nodes without images (no processes) have no tarball
+        # (tarball is checksummed while it is written)
+        on_host $host "set -o pipefail; cd $chkimgdir || exit 1; if ls *.dmtcp > /dev/null 2>&1; then tar -cf - *.dmtcp | tee $chkhostimages.tmp/$i.tar | md5sum | sed s/-/$i.tar/ > $chkhostimages.tmp/$i.md5; fi" &
+        pids="$pids $!"
+        i=$(($i + 1))
+    done
+    ec=0
+    for pid in $pids
+    do
+        wait $pid || ec=1
+    done
+    if [ $ec -ne 0 ] || [ -z "`ls $chkhostimages.tmp/`" ]
+    then
+        myecho "Failed to collect checkpoint images of all nodes"
+        rm -Rf "$chkhostimages.tmp"
+        return 1
+    fi
+    cat $chkhostimages.tmp/[0-9]*.md5 > "$chkhostimages.tmp/$IMAGESUMS"
+    rm -f $chkhostimages.tmp/[0-9]*.md5
+    echo $hosts > "$chkhostimages.tmp/hosts"
+    rm -Rf "$chkhostimages.old"
+    if [ -d "$chkhostimages" ]
+    then
+        mv "$chkhostimages" "$chkhostimages.old"
+    fi
+    mv "$chkhostimages.tmp" "$chkhostimages"
+    rm -Rf "$chkhostimages.old"
+    myecho "Collected checkpoint images of `ls $chkhostimages/*.tar | wc -l` node(s) in $chkhostimages"
+    on_all_hosts "rm -f $chkimgdir/*.dmtcp"
+}
+
+# distribute the collected checkpoint images over the nodes of this job (in parallel): the images of the n-th node
+# of the checkpointed job go to the n-th node of this job (the first node is always the one running this script)
+# sets $rank_hosts (nodes with images) and $expected_peers (number of images)
+scatter_images () {
+    hosts=(`job_hosts`)
+    rank_hosts=""
+    expected_peers=0
+    pids=""
+    for tarball in `ls $chkhostimages/*.tar`
+    do
+        i=`basename $tarball .tar`
+        if [ $i -ge ${#hosts[@]} ]
+        then
+            myecho "Checkpoint has images of more nodes than available (${#hosts[@]}), can't restart"
+            return 1
+        fi
+        on_host ${hosts[$i]} "rm -Rf $chkimgdir && mkdir -p $chkimgdir && tar -xf $tarball -C $chkimgdir" &
+        pids="$pids $!"
+        rank_hosts="$rank_hosts ${hosts[$i]}"
+        expected_peers=$(($expected_peers + `tar -tf $tarball | wc -l`))
+    done
+    ec=0
+    for pid in $pids
+    do
+        wait $pid || ec=1
+    done
+    if [ $ec -ne 0 ]
+    then
+        myecho "Failed to distribute checkpoint images over the nodes"
+        return 1
+    fi
+    myecho "Restarting $expected_peers process(es) on node(s):$rank_hosts"
+}
+
+# start DMTCP coordinator as daemon, sets $coord_port
+# (using --new-coordinator doesn't seem to work for restart, and with --mpi processes on other nodes connect to it)
+start_coordinator () {
+    # coordinator writes port file once it is listening
+    rm -f "$chkdir/$PORTFILE"
+    $DMTCP_COORDINATOR --daemon --coord-logfile "$chkdir/coord.log.$$" --coord-port 0 --port-file "$chkdir/$PORTFILE" --ckptdir $chkimgdir --exit-on-last --interval 0
+    wait_for_file "$chkdir/$PORTFILE"
+    if [ $? -ne 0 ]
+    then
+        return 1
+    fi
+    coord_port=$(cat "$chkdir/$PORTFILE")
+    myecho "DMTCP coordinator port: $coord_port"
+}
+
+# restart processes from the collected checkpoint images on all nodes (with --mpi), sets $script_pid
+restart_ranks () {
+    scatter_images
+    if [ $? -ne 0 ]
+    then
+        return 1
+    fi
+    myhost=`hostname`
+    rank_pids=""
+    for host in $rank_hosts
+    do
+        if [ "$host" != "$myhost" ]
+        then
+            on_host $host "$DMTCP_RESTART --coord-host $myhost --coord-port $coord_port $chkimgdir/*.dmtcp" &
+            rank_pids="$rank_pids $!"
+        fi
+    done
+    $DMTCP_SESSION $DMTCP_RESTART --coord-host $myhost --coord-port $coord_port $chkimgdir/*.dmtcp &
+    script_pid=$!
+}
+
+# clean up after a failed restart: quit the coordinator (which kills all processes connected to it, processes
+# that did not connect yet can't connect anymore), and kill the restart and remote shells (with --mpi)
+abort_restart () {
+    $DMTCP_COMMAND --port $coord_port --quit > /dev/null 2>&1
+    kill -9 $script_pid $rank_pids 2> /dev/null
+    script_pid=""
+    rank_pids=""
+}
+
+# resource usage of process $1 and all its descendants, in one line:
+# <resident memory (bytes)> <virtual memory (bytes)> <CPU time (seconds)> <number of processes> <pid> ...
+tree_usage () {
+    ps -e -o pid= -o ppid= -o rss= -o vsz= -o times= | awk -v root=$1 '{
+        parent[$1] = $2
+        rss[$1] = $3
+        vsz[$1] = $4
+        cpu[$1] = $5
+    }
+    END {
+        for (p in rss) {
+            q = p
+            while (q != root && q in parent && q > 1) {
+                q = parent[q]
+            }
+            if (q == root) {
+                r += rss[p]
+                v += vsz[p]
+                c += cpu[p]
+                n++
+                pids = pids " " p
+            }
+        }
+        print r * 1024, v * 1024, c + 0, (n + 0) pids
+    }'
+}
+
+# total resident memory (bytes) of process $1 and all its descendants
+tree_rss () {
+    tree_usage $1 | cut -d' ' -f1
+}
+
+# append sample of resource usage of the checkpointed processes to $chkprofile (with --profile),
+# and update peaks in job state (only when they grow, to keep the overhead low)
+profile_sample () {
+    local usage=(`tree_usage $script_pid`)
+    if [ ${usage[3]:-0} -eq 0 ]
+    then
+        return 0
+    fi
+    # I/O of the processes that are still running (like CPU time, usage of processes that exited is lost)
+    local io=`for pid in ${usage[@]:4}; do cat /proc/$pid/io; done 2> /dev/null | \
+        awk '$1 == "read_bytes:" { r += $2 } $1 == "write_bytes:" { w += $2 } END { print r + 0, w + 0 }'`
+    echo "$%(CSUB_JOBID)s `date +%%s` ${usage[@]:0:3} $io ${usage[3]}" >> "$chkprofile"
+    local updates=""
+    if [ ${usage[0]} -gt ${peak_rss:-0} ]
+    then
+        peak_rss=${usage[0]}
+        updates="$updates peak_rss=$peak_rss"
+    fi
+    if [ ${usage[1]} -gt ${peak_vsz:-0} ]
+    then
+        peak_vsz=${usage[1]}
+        updates="$updates peak_vsz=$peak_vsz"
+    fi
+    if [ ${usage[3]} -gt ${peak_procs:-0} ]
+    then
+        peak_procs=${usage[3]}
+        updates="$updates peak_procs=$peak_procs"
+    fi
+    if [ -n "$updates" ]
+    then
+        state_set "$chkstate" $updates
+    fi
+}
+
+# virtual memory to request (e.g. 1200mb) for the peak virtual memory use in the job state, plus a margin
+# (empty if the job was not profiled yet)
+profile_vmem () {
+    peak=`state_get "$chkstate" peak_vsz`
+    if [ -n "$peak" ]
+    then
+        echo "$((($peak * (100 + $vmem_margin) / 100 + 1048575) / 1048576))mb"
+    fi
+}
+
+# point $chkimgdir to node-local storage if checkpoint images of $1 bytes fit there (with a margin
+# of $storage_margin %%), or to shared storage otherwise (only with --auto_storage and node-local job dir)
+choose_image_dir () {
+    if (( ! $auto_images ))
+    then
+        return 0
+    fi
+    if fits_in $1 "$chkdir"
+    then
+        target=images.local
+        mkdir -p "$chkdir/$target"
+    else
+        target="$chkimgshared"
+        mkdir -p "$target"
+    fi
+    if [ "`readlink $chkimgdir`" != "$target" ]
+    then
+        myecho "Checkpoint images (about $1 bytes, $free bytes free on node) go to $target"
+        ln -s -f -n "$target" "$chkimgdir"
+    fi
+}
+
 epilogue () {
 	# replaced either by actual epilogue or a simple echo commented out
 	%(epilogue)s ${%(CSUB_JOBID)s} "" "" ${%(CSUB_JOBNAME)s} %(cleanup_chkpt)d
@@ -150,7 +723,9 @@ epilogue () {
 }
 
 endjob () {
-    touch job.normal
+    # next job queued at start of job is not needed (unless it was handed over in resubmit)
+    cancel_continuation
+    state_set "$chkstate" end=normal
     if [ -f $chkbaseout ]
     then
         cat $chkbaseout >> $chkbaseout.all
@@ -161,39 +736,144 @@ endjob () {
     fi
 }
 
+# qsub options for the next job: wall time based on history (with --adaptive_chkpt_time), virtual memory
+# based on profile (with --vmem=auto) and nodes to avoid (sets $walltime_opt, $vmem_opt and $exclude_opt)
+continuation_opts () {
+    walltime_opt=""
+    if (( $adaptive_chkpt_time ))
+    then
+        budget=`chkpt_budget`
+        if [ -n "$budget" ]
+        then
+            myecho "Checkpoint time based on history: $budget seconds"
+            walltime_opt="-l walltime=$(($chksltot + $budget))"
+        fi
+    fi
+    vmem_opt=""
+    if (( $auto_vmem ))
+    then
+        vmem=`profile_vmem`
+        if [ -n "$vmem" ]
+        then
+            myecho "Virtual memory based on profile: $vmem"
+            vmem_opt="-l vmem=$vmem"
+        fi
+    fi
+    exclude_opt=""
+    if [ -s "$chkfailednodes" ]
+    then
+        exclude_opt="%(CSUB_EXCLUDE_NODES)s`sort -u "$chkfailednodes" | paste -s -d:`"
+        myecho "Excluding nodes on which restart failed: `sort -u "$chkfailednodes" | paste -s -d' '`"
+    fi
+}
+
+# excluding nodes is a Moab extension (-W x=), that the scheduler may reject: second attempt to submit goes without
+drop_exclude_opt () {
+    if [ -n "$exclude_opt" ]
+    then
+        myecho "Not excluding nodes on which restart failed for second attempt to submit"
+        exclude_opt=""
+    fi
+}
+
+# submit the next job early (with --prequeue), so it waits in the queue while this job is running;
+# it depends on this job, and is handed over in resubmit or cancelled by endjob
+prequeue () {
+    if (( ! $prequeue ))
+    then
+        return 0
+    fi
+    # next job queued by an earlier job that did not hand it over (e.g. it crashed, or the job was resumed)
+    cancel_continuation
+    continuation_opts
+    out=`qsub $walltime_opt $vmem_opt $exclude_opt -W depend=afterok:$%(CSUB_JOBID)s "$chkdir/base"`
+    if [ $? -gt 0 ]
+    then
+        drop_exclude_opt
+        out=`qsub $walltime_opt $vmem_opt -N $jobname -W depend=afterok:$%(CSUB_JOBID)s "$chkdir/base"`
+    fi
+    if [ $? -gt 0 ]
+    then
+        myecho "Submitting next job failed, it will be submitted at the end of the job. Output: $out"
+        return 1
+    fi
+    mkdir -p "`dirname $chknextjob`"
+    echo $out > "$chknextjob"
+    if [ $? -gt 0 ]
+    then
+        # can't be handed over without its job id, a duplicate would be submitted at the end of the job
+        myecho "Failed to record next job $out, cancelling it"
+        qdel $out > /dev/null 2>&1
+        return 1
+    fi
+    myecho "Next job $out queued"
+}
+
+# cancel next job queued by prequeue (if any)
+cancel_continuation () {
+    if [ -f "$chknextjob" ]
+    then
+        nextjob=`cat "$chknextjob"`
+        if [ -n "$nextjob" ] && [ "$nextjob" != "$%(CSUB_JOBID)s" ]
+        then
+            myecho "Cancelling next job $nextjob"
+            qdel $nextjob > /dev/null 2>&1
+        fi
+        rm -f "$chknextjob"
+    fi
+}
+
 resubmit () {
     fun=resubmit
     myecho
     myecho "begin $fun `date`"
+    local phase_start=`date +%%s`
 
     myexit=0
-    ## resubmit this job (-N is required for array jobs!)
-    ## the rest of this job should finish before all else
-    out=`qsub -W depend=afterok:$%(CSUB_JOBID)s "$chkdir/base"`
-    if [ $? -gt 0 ]
+    continuation_opts
+    nextjob=`cat "$chknextjob" 2> /dev/null`
+    if [ -n "$nextjob" ] && qstat $nextjob > /dev/null 2>&1
     then
-        myecho "Job resubmit failed."
-        myecho "Job resubmit output): $out"
-        sleep 5
-        out=`qsub -N $jobname -W depend=afterok:$%(CSUB_JOBID)s "$chkdir/base"`
+        ## next job was queued at start of job, hand it over (it must not be cancelled by endjob)
+        rm -f "$chknextjob"
+        myecho "Job resubmit not needed, next job $nextjob was queued at start of job."
+        index_state resubmitted $nextjob
+        ## rely on epilogue for backup
+        myexit=1
+    else
+        ## resubmit this job (-N is required for array jobs!)
+        ## the rest of this job should finish before all else
+        out=`qsub $walltime_opt $vmem_opt $exclude_opt -W depend=afterok:$%(CSUB_JOBID)s "$chkdir/base"`
         if [ $? -gt 0 ]
         then
-            myecho "Job resubmit failed again."
-            myecho "Job resubmit output: $out"
+            myecho "Job resubmit failed."
+            myecho "Job resubmit output): $out"
+            sleep 5
+            drop_exclude_opt
+            out=`qsub $walltime_opt $vmem_opt -N $jobname -W depend=afterok:$%(CSUB_JOBID)s "$chkdir/base"`
+            if [ $? -gt 0 ]
+            then
+                myecho "Job resubmit failed again."
+                myecho "Job resubmit output: $out"
+                index_state failed
+            else
+                myecho "Job resubmit succesful second time."
+                myecho "Job resubmit output: $out"
+                index_state resubmitted "$out"
+                ## rely on epilogue for backup
+                myexit=1
+            fi
         else
-            myecho "Job resubmit succesful second time."
+            myecho "Job resubmit succesful."
             myecho "Job resubmit output: $out"
+            index_state resubmitted "$out"
             ## rely on epilogue for backup
             myexit=1
         fi
-    else
-        myecho "Job resubmit succesful."
-        myecho "Job resubmit output: $out"
-        ## rely on epilogue for backup
-        myexit=1
     fi
 
 
+    metrics_event resubmit $phase_start
     myecho "end $fun `date`"
     myecho "EXITING BASE `date` $%(CSUB_JOBID)s"
     myecho
@@ -211,25 +891,56 @@ restart () {
     fun=restart
     myecho
     myecho "begin $fun `date`"
+    local phase_start=`date +%%s`
+    ## newest valid set of checkpoint images: last checkpoint, or periodic checkpoint generation
+    ## (validated once, not again when retrying)
+    if [ -z "$chkimgset" ]
+    then
+        for chkset in `image_sets`
+        do
+            validate_images "$chkset"
+            if [ $? -eq 0 ]
+            then
+                chkimgset=$chkset
+                break
+            fi
+            myecho "No valid checkpoint images in $chkset"
+        done
+        if [ -z "$chkimgset" ]
+        then
+            myecho "No valid checkpoint images found, restart can't succeed. Giving up."
+            index_state failed
+            endjob
+            exit 11
+        fi
+        if [ "$chkimgset" != "$chkimgdir" ] && [ "$chkimgset" != "$chkhostimages" ]
+        then
+            myecho "Using checkpoint generation $chkimgset"
+            if [ -z "`state_get "$chkstate" chkpt`" ]
+            then
+                # crash before first checkpoint at end of job
+                state_set "$chkstate" chkpt=0
+            fi
+        fi
+    fi
+    chkimages=`find $chkimgset/ -maxdepth 1 -name '*.dmtcp'`
+
     ## sanity check
-    for f in $chkid
-    do
-      if [ ! -f "$f" ]
-      then
-	  myecho "File $f missing"
+    chkptid=`state_get "$chkstate" chkpt`
+    if [ -z "$chkptid" ]
+    then
+	  myecho "Checkpoint count missing in job state $chkstate"
 	  return 0
-      fi
-    done
-
-    chkptid=`cat $chkid`
+    fi
 
     ## failure retry
-    if [ -f "$chkrecount" ]
+    crcount=`state_get "$chkstate" restarts`
+    if [ -n "$crcount" ]
     then
-    	crcount=`cat "$chkrecount"`
     	if [ $crcount -gt $crcountmax ]
 	    then
 	       myecho "No more retries (max: $crcountmax). Giving up."
+	       index_state failed
 	       endjob
 	       exit 10
 	    fi
@@ -237,79 +948,85 @@ restart () {
 	   crcount=0
     fi
 
-    # resume from checkpoint
-    # wait until resume is actually complete via lockfile
-    rm -f "$chkrestat"
-    rm -f "$chklock"
-    lockfile "$chklock"
-    # using --new-coordinator doesn't seem to work, so start DMTCP coordinator ourselves as daemon and use that
-    $DMTCP_COORDINATOR --daemon --coord-logfile "$chkdir/coord.log.$$" --coord-port 0 --port-file "$chkdir/$PORTFILE" --ckptdir $chkdir --exit-on-last --interval 0
-    # give DMTCP coordinator some time to start...
-    sleep 3
-    coord_port=$(cat "$chkdir/$PORTFILE")
-    myecho "DMTCP coordinator port: $coord_port"
-    $DMTCP_RESTART --coord-port $coord_port `find $chkdir -name '*.dmtcp'` &
-    script_pid=$!
-    myecho "PID of relaunched script: $script_pid"
-    # check status of relaunched script shortly after
-    sleep 5
-    kill -0 $script_pid 2> /dev/null
-    if [ $? -eq 0 ]; then
-        echo OK > "$chkrestat" && rm -f "$chklock"
-    else
-        echo FAILURE > "$chkrestat" && rm -f "$chklock"
-    fi
-    lockfile "$chklock"
-    rm -f "$chklock"
-
-	echo $script_pid > $CSUB_MASTER_PID_FILE
-
-    crstat='UNKNOWN'
-    if [ -f "$chkrestat" ]
+    # resume from checkpoint, lock makes sure the same checkpoint is never restarted twice concurrently
+    crstat=FAILURE
+    crlaunched=0
+    exec 8> "$chklock"
+    flock -w $chkready_timeout 8
+    if [ $? -eq 0 ]
     then
-        crstat=`cat "$chkrestat"`
-        rm -Rf "$chkrestat"
-    else
-        myecho "Restart status file $chkrestat not found. Is this a restart failure?"
-        sleep 5
-        kill -0 $script_pid 2> /dev/null
+        # lock is not inherited by the coordinator and the restarted processes
+        start_coordinator 8>&-
         if [ $? -eq 0 ]
         then
-            myecho "Restart status check: Process running."
-            crstat='OK'
-        else
-            myecho "Restart status check: Process not running."
-            crstat='FAILURE'
+            if (( $mpi ))
+            then
+                restart_ranks 8>&-
+            else
+                $DMTCP_SESSION $DMTCP_RESTART --coord-port $coord_port $chkimages 8>&- &
+                script_pid=$!
+            fi
+            if [ $? -eq 0 ]
+            then
+                myecho "PID of relaunched script: $script_pid"
+                crlaunched=1
+                # restart is complete once the coordinator reports the restarted process(es) as running
+                wait_until_running $script_pid
+                if [ $? -eq 0 ]
+                then
+                    crstat=OK
+                fi
+            fi
+            if [ "$crstat" != "OK" ]
+            then
+                abort_restart
+            fi
         fi
+    else
+        myecho "Failed to get lock $chklock within $chkready_timeout seconds"
     fi
+    exec 8>&-
 
     chkptid=$(($chkptid + 1))
 
     case $crstat in
 	OK)
 	    myecho "Succesful restart main id $chkptid restart nr $crcount at `hostname`"
-	    echo $chkptid > $chkid
-	    rm -f "$chkrecount"
+	    state_set "$chkstate" chkpt=$chkptid restarts= pid=$script_pid
+	    index_state running
+	    # restarts succeed again, so no nodes need to be excluded anymore
+	    rm -f "$chkfailednodes"
 	    cleanup_after_restart=%(cleanup_after_restart)d
 	    if (( $cleanup_after_restart ))
 	    then
 	    	myecho "Cleaning up checkpoint file(s) and tarball after successful restart..."
-	    	rm "$chkdir/*.dmtcp" "$chktarb"
+	    	rm "$chkimgdir/*.dmtcp" "$chktarb"
+	    	# incremental layers are useless without tarball, next pack will be a full one
+	    	rm -f "$chktarb.md5" "$chktarb.manifest" "$chktarb.layers" "$chktarb".layer.* "$chktarb.recipe"
 	    fi
 	    ;;
 	FAILURE)
 	    crcount=$(($crcount + 1))
-	    echo $crcount > $chkrecount
+	    state_set "$chkstate" restarts=$crcount pid=$script_pid
+	    index_state restart_failed
 
 	    myecho "Failed restart restart main id $chkptid restart nr $crcount of $crcountmax at `hostname`"
 	    myecho "Begin of restart output"
 	    cat $chkreout
 	    myecho "End of restart output"
+	    # dmtcp_restart failed on valid images, so this node may be the problem: don't run the resubmitted job here
+	    # (not when the lock or the coordinator failed)
+	    if (( $crlaunched ))
+	    then
+	        hostname >> "$chkfailednodes"
+	    fi
 	    # double percent character for module operation, because this script is pushed through Python string formatting!
 	    if [ $(($crcount%%2)) -eq 1 ]
             then
-	        ## retry start
-	        myecho "Attempt to restart"
+	        ## retry start, after some time
+	        delay=`restart_delay $crcount`
+	        myecho "Attempt to restart in $delay seconds"
+	        sleep $delay
 		    restart
 	    else
 	        myecho "Attempt to resubmit"
@@ -321,6 +1038,7 @@ restart () {
 	    myecho "Unknown restart state: $crstat"
 	    ;;
     esac
+    metrics_event restart $phase_start
     myecho "end $fun `date`"
     myecho
 }
@@ -329,17 +1047,18 @@ firststart () {
     fun=firststart
     myecho
     myecho "begin $fun `date`"
+    local phase_start=`date +%%s`
 
     ## failure retry
-    if [ -f $startcount ]
+    stcount=`state_get "$chkstate" starts`
+    if [ -n "$stcount" ]
     then
-        ls -l $startcount
-    	stcount=`cat $startcount`
     	myecho "start attempt $stcount failed, retrying..."
     	stcount=$(($stcount+1))
     	if [ $stcount -ge $stcountmax ]
 	    then
 	       myecho "Failed to start job, even after $stcountmax tries. Giving up."
+	       index_state failed
 	       endjob
 	       exit 20
 	    fi
@@ -347,25 +1066,222 @@ firststart () {
         myecho "starting"
     	stcount=0
 	fi
-	echo $stcount > $startcount
-
-    echo 0 > $chkid
+	state_set "$chkstate" starts=$stcount chkpt=0
     if [ -f "$chkprestage" ]
     then
 	   "$chkprestage"
     fi
-    $DMTCP_LAUNCH --coord-logfile "$chkdir/coord.log.$$" --interval 0 --ckptdir "$chkdir" --new-coordinator --port-file $chkdir/$PORTFILE bash -c "./${scriptname} > ${jobout} 2> ${joberr}" &
+    rm -f "$chkdir/$PORTFILE"
+    choose_image_dir $image_estimate
+    if (( $mpi ))
+    then
+        # processes started on other nodes (e.g. by mpirun) connect to the coordinator on this node
+        on_all_hosts "mkdir -p $chkimgdir"
+        start_coordinator
+        if [ $? -ne 0 ]
+        then
+            myecho "DMTCP coordinator did not start (see $chkdir/coord.log.$$)... Exiting!"
+            index_state failed
+            exit 1
+        fi
+        $DMTCP_SESSION $DMTCP_LAUNCH --coord-logfile "$chkdir/coord.log.$$" --interval 0 --ckptdir "$chkimgdir" --join-coordinator --coord-host `hostname` --coord-port $coord_port bash -c "./${scriptname} > ${jobout} 2> ${joberr}" &
+    else
+        $DMTCP_SESSION $DMTCP_LAUNCH --coord-logfile "$chkdir/coord.log.$$" --interval 0 --ckptdir "$chkimgdir" --new-coordinator --port-file $chkdir/$PORTFILE bash -c "./${scriptname} > ${jobout} 2> ${joberr}" &
+    fi
     script_pid=$!
     myecho "PID of running script: $script_pid"
-    # check status of process shortly after launch
-    sleep 5
-    kill -0 $script_pid 2> /dev/null
+    # launch is complete once the coordinator reports the process as running
+    wait_until_running $script_pid
     if [ $? -eq 0 ]; then
-    	echo $script_pid > "$CSUB_MASTER_PID_FILE"
+    	state_set "$chkstate" pid=$script_pid
+    	index_state running
     else
     	echo "PID of process running $scriptname not found... Exiting!"
+    	index_state failed
     	exit 1
     fi
+    metrics_event firststart $phase_start
+    myecho "end $fun `date`"
+    myecho
+}
+
+# wait at most $1 seconds for the checkpointed process to exit
+# blocking wait on the process, so we wake up as soon as it exits;
+# watchdog interrupts the wait with SIGUSR1 when the time is up
+# returns 0 if the process exited
+wait_for_process () {
+    trap 'true' USR1
+    (
+        trap 'kill $sleep_pid 2> /dev/null; exit 0' TERM
+        sleep $1 &
+        sleep_pid=$!
+        wait $sleep_pid
+        kill -USR1 $$
+    ) &
+    watchdog_pid=$!
+    wait $script_pid
+    kill $watchdog_pid 2> /dev/null
+    # the watchdog may be sending USR1 right now: ignore it rather than reset to the default action (exit)
+    trap '' USR1
+    kill -0 $script_pid 2> /dev/null
+    if [ $? -eq 0 ]
+    then
+        return 1
+    fi
+    return 0
+}
+
+# handler for checkpoint signal $1: only sets a flag, the wait in chkptsleep is interrupted by the signal,
+# checkpoint and resubmit happen in the main flow (signals received while checkpointing are ignored)
+on_chkpt_signal () {
+    if (( ! $chkpt_signalled ))
+    then
+        myecho "Received SIG$1 `date`, checkpointing as soon as possible"
+    fi
+    chkpt_signalled=1
+}
+
+# the checkpointed process runs in its own session (see DMTCP_SESSION), and with --mpi processes are restarted on
+# other nodes over $CSUB_RSH (see restart_ranks), out of reach of the scheduler: kill them and their coordinator
+# if base exits while the process is still running
+kill_session () {
+    if kill -0 $script_pid 2> /dev/null
+    then
+        myecho "Killing checkpointed process $script_pid and its coordinator"
+        $DMTCP_COMMAND --port $coord_port --quit > /dev/null 2>&1
+        kill -9 -- -$script_pid 2> /dev/null
+    fi
+}
+
+# EXIT trap (also runs on e.g. SIGTERM): see kill_session, and with --mpi remove the node-local images on all nodes
+# (they are collected in shared storage after every checkpoint, see gather_images)
+cleanup_exit () {
+    kill_session
+    if (( $mpi ))
+    then
+        on_all_hosts "rm -Rf $chkimgdir"
+    fi
+}
+
+# base itself may be killed (SIGKILL) before it can clean up, e.g. when the grace period is too short to
+# checkpoint: a guard in its own session then kills the checkpointed process and its coordinator
+guard_session () {
+    setsid bash -c "while kill -0 $$ && kill -0 $script_pid; do sleep 1; done 2> /dev/null
+        if kill -0 $script_pid 2> /dev/null
+        then
+            $DMTCP_COMMAND --port $coord_port --quit
+            kill -9 -- -$script_pid
+        fi" < /dev/null > /dev/null 2>&1 &
+}
+
+# optimal interval between periodic checkpoints (Young/Daly): sqrt(2 * cost * MTBF) - cost
+chkpt_interval () {
+    awk -v c=$chkpt_cost -v m=$chkpt_mtbf 'BEGIN {
+        # checkpoints that take less than a second are measured as 0 seconds, which would give an interval of 0
+        if (c < 1) {
+            c = 1
+        }
+        t = sqrt(2 * c * m) - c
+        if (t < c) {
+            t = c
+        }
+        print int(t)
+    }'
+}
+
+# newest complete checkpoint generation (empty if none)
+latest_generation () {
+    if [ -d "$chkgendir" ]
+    then
+        gen=`ls "$chkgendir" | grep -v tmp | sort -n | tail -1`
+        if [ -n "$gen" ]
+        then
+            echo "$chkgendir/$gen"
+        fi
+    fi
+}
+
+# publish current checkpoint images atomically as a new generation, keep last $chkpt_generations
+publish_generation () {
+    gen=`timestamp_latest_checkpoint`
+    mkdir -p "$chkgendir/$gen.tmp"
+    for img in `find $chkimgdir/ -maxdepth 1 -name '*.dmtcp'`
+    do
+        # DMTCP writes a new image to a temporary file and renames it, so a hard link is safe
+        ln "$img" "$chkgendir/$gen.tmp/" 2> /dev/null || cp -p "$img" "$chkgendir/$gen.tmp/"
+        if [ $? -gt 0 ]
+        then
+            myecho "Failed to publish checkpoint generation $gen"
+            rm -Rf "$chkgendir/$gen.tmp"
+            return 1
+        fi
+    done
+    if [ -f "$chkimgdir/$IMAGESUMS" ]
+    then
+        cp -p "$chkimgdir/$IMAGESUMS" "$chkgendir/$gen.tmp/"
+    fi
+    rm -Rf "$chkgendir/$gen"
+    mv "$chkgendir/$gen.tmp" "$chkgendir/$gen"
+    myecho "Published checkpoint generation $gen"
+    for old in `ls "$chkgendir" | grep -v tmp | sort -n | head -n -$chkpt_generations`
+    do
+        rm -Rf "$chkgendir/$old"
+    done
+}
+
+# choose storage for the checkpoint images that are about to be written (see choose_image_dir):
+# images are expected to be as large as the memory in use, or the previous images
+expected_image_size () {
+    if (( $auto_images ))
+    then
+        rss=`tree_rss $script_pid`
+        previous=`image_bytes`
+        if [ ${rss:-0} -gt $previous ]
+        then
+            choose_image_dir ${rss:-0}
+        else
+            choose_image_dir $previous
+        fi
+    fi
+}
+
+# remove checkpoint images in node-local storage once newer images are written to shared storage
+# (images in shared storage are removed by epilogue once a tarball with newer images is packed)
+drop_stale_images () {
+    if (( $auto_images )) && [ "`readlink $chkimgdir`" != "images.local" ]
+    then
+        rm -f "$chkdir/images.local/"*.dmtcp
+    fi
+}
+
+periodic_chkpt () {
+    fun=periodic_chkpt
+    myecho
+    myecho "begin $fun `date`"
+    local phase_start=`date +%%s`
+    chkpt_start=`date +%%s`
+    coord_port=$(cat "$chkdir/$PORTFILE")
+    expected_image_size
+    # checkpoint & wait until checkpointing is done, process keeps running
+    $DMTCP_COMMAND --port $coord_port --bcheckpoint
+    if [ $? -eq 0 ]
+    then
+        drop_stale_images
+        if (( $mpi ))
+        then
+            # collected images are in shared storage, so they survive a node crash
+            gather_images
+        else
+            record_image_sums
+            publish_generation
+        fi
+    else
+        myecho "Periodic checkpoint failed."
+    fi
+    chkpt_cost=$((`date +%%s` - $chkpt_start))
+    # don't mistake this checkpoint for one made by the user in makechkpt
+    chkfile_lastTime=`timestamp_latest_checkpoint`
+    metrics_event periodic_chkpt $phase_start
     myecho "end $fun `date`"
     myecho
 }
@@ -374,19 +1290,64 @@ chkptsleep () {
     fun=chkptsleep
     myecho
     myecho "begin $fun `date`"
+    local phase_start=`date +%%s`
     ## else, sleep
-    sleeping=0
-    while [ $sleeping -lt $chksltot ]
+    ## with periodic checkpointing, sleep in slices of optimal checkpoint interval,
+    ## with profiling, in slices of (at most) the sampling interval
+    sleep_end=$((`date +%%s` + $chksltot))
+    next_chkpt=$(($sleep_end + 1))
+    if (( $chkpt_mtbf ))
+    then
+        next_chkpt=$((`date +%%s` + `chkpt_interval`))
+    fi
+    if (( $profile_interval ))
+    then
+        peak_rss=`state_get "$chkstate" peak_rss`
+        peak_vsz=`state_get "$chkstate" peak_vsz`
+        peak_procs=`state_get "$chkstate" peak_procs`
+    fi
+    while (( ! $chkpt_signalled ))
     do
-      # reverse 1s for actual check
-      sleep $(($chkslint-1))
-      # exit sleep loop as soon as process is no longer there
-      kill -0 $script_pid 2> /dev/null
-      if [ $? -ne 0 ]; then
-        return
-      fi
-      sleeping=$(($sleeping+$chkslint))
+        now=`date +%%s`
+        slice=$(($sleep_end - $now))
+        if [ $(($next_chkpt - $now)) -lt $slice ]
+        then
+            slice=$(($next_chkpt - $now))
+        fi
+        if (( $profile_interval )) && [ $profile_interval -lt $slice ]
+        then
+            slice=$profile_interval
+        fi
+        if [ $slice -le 0 ]
+        then
+            break
+        fi
+        wait_for_process $slice
+        if [ $? -eq 0 ]
+        then
+            break
+        fi
+        if (( $chkpt_signalled ))
+        then
+            myecho "Sleep interrupted by checkpoint signal `date`"
+            break
+        fi
+        if (( $profile_interval ))
+        then
+            profile_sample
+        fi
+        if [ `date +%%s` -ge $sleep_end ]
+        then
+            myecho "Sleep budget of $chksltot seconds used up `date`"
+            break
+        fi
+        if [ `date +%%s` -ge $next_chkpt ]
+        then
+            periodic_chkpt
+            next_chkpt=$((`date +%%s` + `chkpt_interval`))
+        fi
     done
+    metrics_event chkptsleep $phase_start
     myecho "end $fun `date`"
     myecho
 }
@@ -395,6 +1356,13 @@ makechkpt () {
     fun=makechkpt
     myecho
     myecho "begin $fun `date`"
+    local phase_start=`date +%%s`
+    index_state checkpointing
+    chkpt_start=`date +%%s`
+    if (( $lazy_restore ))
+    then
+        record_hot_set
+    fi
     chkfile_curTime=`timestamp_latest_checkpoint`
     myecho "chkfile_lastTime: $chkfile_lastTime; chkfile_curTime: $chkfile_curTime"
     if [ "$chkfile_curTime" -gt "$chkfile_lastTime" ]; then
@@ -409,42 +1377,90 @@ makechkpt () {
         myecho "No recent checkpoint found, so checkpointing..."
         coord_port=$(cat "$chkdir/$PORTFILE")
         myecho "DMTCP coordinator port: $coord_port"
+        expected_image_size
         # checkpoint & wait until checkpointing is done
         # note: specified kill mode '%(CSUB_KILL_MODE)s' is blatently ignored here,
         # DMTCP does not support sending a particular signal
         $DMTCP_COMMAND --port $coord_port --bcheckpoint
+        if [ $? -eq 0 ]
+        then
+            drop_stale_images
+        fi
         # kill processes & DMTCP coordinator
         $DMTCP_COMMAND --port $coord_port --quit
     fi
+    if (( $mpi ))
+    then
+        gather_images
+    else
+        record_image_sums
+    fi
+    duration=$((`date +%%s` - $chkpt_start))
+    record_duration makechkpt $duration
+    if (( $profile_interval ))
+    then
+        # checkpoint rate (bytes/second), to predict the checkpoint time from the memory use (see chkpt_budget)
+        state_set "$chkstate" chkpt_rate=$((`image_bytes` / ($duration > 0 ? $duration : 1)))
+    fi
+    metrics_event makechkpt $phase_start `image_bytes`
     myecho "end $fun `date`"
     myecho
 }
 
+# record files the job needs right after a restart (with --lazy_restore): files opened by the checkpointed processes,
+# and files modified since the job started, relative to the job dir (checkpoint dir is always packed with the images)
+record_hot_set () {
+    (
+        cd "$localdir"
+        for pid in `tree_usage $script_pid | cut -d' ' -f5-`
+        do
+            readlink /proc/$pid/fd/*
+        done 2> /dev/null | awk -v dir="$localdir/" 'index($0, dir) == 1 { print "./" substr($0, length(dir) + 1) }'
+        find . -path ./%(chkptsubdir)s -prune -o -type f -newermt @$job_start -print
+    ) | grep -v '^\./%(chkptsubdir)s/' | sort -u > "$chkhotset"
+    myecho "Hot set for restart: `wc -l < "$chkhotset"` files"
+}
+
+%(wait_for_restore)s
+# remove checkpoint dir of completed job, except for the job state (which may be in there, it is still needed
+# by the epilogue and removed with the job dir)
+remove_chkdir () {
+    find "$chkdir" -mindepth 1 -maxdepth 1 ! -name 'chkpt.state*' -exec rm -Rf {} +
+}
+
 endofjob () {
     fun=endofjob
     myecho
     myecho "begin $fun `date`"
+    local phase_start=`date +%%s`
     # Add stdout and stderr to central files
     if [ -f "$chkpoststage" ]
     then
        tmpdir=$(mktemp -d)
        cp -a "$chkpoststage" "$tmpdir/poststage"
        chmod +x "$tmpdir/poststage"
+       # list of files copied in by prestage, to only copy new or changed files
+       if [ -f "$chkdir/prestage.staged" ]
+       then
+           cp -a "$chkdir/prestage.staged" "$tmpdir/prestage.staged"
+       fi
        if (( %(cleanup_chkpt)d ))
        then
-       		rm -Rf "$chkdir"
+       		remove_chkdir
        fi
        "$tmpdir/poststage"
     else
        if (( %(cleanup_chkpt)d ))
        then
-       		rm -Rf "$chkdir"
+       		remove_chkdir
        fi
     fi
     endjob
 
-    touch job.complete
+    state_set "$chkstate" end=complete
+    index_state complete
 
+    metrics_event endofjob $phase_start
     myecho "end $fun `date`"
     myecho
 }
@@ -455,12 +1471,15 @@ endofjob () {
 
 myecho
 myecho "BEGIN base $%(CSUB_JOBID)s `date`"
+job_start=`date +%%s`
+metrics_event start $job_start
 myecho
 
 # check whether DMTCP is available
 which $DMTCP_COMMAND > /dev/null
 if [ $? -ne 0 ]; then
     myecho "ERROR: DMTCP is not available, aborting job"
+    index_state failed
     endjob
     exit 30
 fi
@@ -472,12 +1491,21 @@ then
     exit 1
 fi
 
-rm -f job.normal
-rm -f job.complete
+state_set "$chkstate" end=
+
+for sig in $chkpt_signals
+do
+    trap "on_chkpt_signal $sig" $sig
+done
+
+if [ -n "$DMTCP_SESSION" ] || (( $mpi ))
+then
+    trap cleanup_exit EXIT
+fi
 
 myecho "Checking for available checkpoints @ ${chkdir}..."
 chkfile_lastTime=`timestamp_latest_checkpoint`
-if [ $chkfile_lastTime -eq 0 ]; then
+if [ $chkfile_lastTime -eq 0 ] && [ -z "`latest_generation`" ]; then
     myecho "No checkpoints found, first start..."
     firststart
 else
@@ -485,6 +1513,15 @@ else
     restart
 fi
 
+if [ -n "$DMTCP_SESSION" ]
+then
+    coord_port=${coord_port:-`cat "$chkdir/$PORTFILE"`}
+    guard_session
+fi
+
+# next job waits in the queue while this job is running
+prequeue
+
 kill -0 $script_pid 2> /dev/null
 if [ $? -ne 0 ]
 then
@@ -493,6 +1530,17 @@ fi
 
 chkptsleep
 
+# the job dir must be complete before it is checkpointed, packed or staged out
+wait_for_restore "$chkrestoring"
+if [ $? -ne 0 ]
+then
+    myecho "ERROR: restoring job dir $localdir failed, not checkpointing it (resume the job from its last checkpoint with csub --resume)"
+    kill -9 $script_pid 2> /dev/null
+    index_state failed
+    cancel_continuation
+    exit 5
+fi
+
 # check whether job is still running or finished
 kill -0 $script_pid 2> /dev/null
 if [ $? -eq 0 ]; then
@@ -500,13 +1548,13 @@ if [ $? -eq 0 ]; then
   resubmit # exits
 else
   # check if job was killed by user after checkpoint
-  if [ -f "$CSUB_KILL_ACK_FILE" ]
+  if [ "`state_get "$chkstate" user_kill`" == "1" ]
   then
   	makechkpt
-  	rm "$CSUB_KILL_ACK_FILE"
+  	state_set "$chkstate" user_kill=
   	if [ $? -ne 0 ]
   	then
-  		myecho "ERROR! Failed to remove file $CSUB_KILL_ACK_FILE. Not resubmitting after checkpoint."
+  		myecho "ERROR! Failed to reset user_kill in job state $chkstate. Not resubmitting after checkpoint."
   		exit 1
   	fi
   	resubmit # exits
@@ -36,7 +36,9 @@ Requires torque >= 2.4.2 and BLCR
 @author: Ward Poelmans (Ghent University)
 """
 
+import hashlib
 import os
+import pipes
 import popen2
 import re
 import shutil
@@ -55,9 +57,11 @@ import sys
 
 csub_vars_map = {
     'CSUB_ARRAY_SEP': '-',  # array seperator, e.g. the '-' in job_name-1 (PBS)
+    'CSUB_EXCLUDE_NODES': '-W x=EXCLUDENODES:',  # qsub option to exclude nodes, followed by ':'-separated list
     'CSUB_JOBID': 'PBS_JOBID',
     'CSUB_JOBNAME': 'PBS_JOBNAME',
     'CSUB_KILL_MODE': 'kill',
+    'CSUB_NODEFILE': 'PBS_NODEFILE',
     'CSUB_O_HOST': 'PBS_O_HOST',
     'CSUB_ORG': 'VSC',
     'CSUB_SCHEDULER': 'PBS',
@@ -73,53 +77,353 @@ BASE = ""
 
 PRESTAGELOCAL = """#!/bin/bash
 
-# copy all files in this directory recursively
-# no hidden files?
+# copy all files in source directory recursively
+# no hidden files in top level of source directory
+# files are copied in parallel via a node-local cache: files that are already in the cache with the same
+# size and mtime (e.g. copied for another array task on this node) are not copied from srcdir again
 srcdir=%(srcdir)s
-if [ -d  $srcdir ]
+# patterns of files to include/exclude: file name, or path relative to srcdir if pattern contains a /
+includes=(%(includes)s)
+excludes=(%(excludes)s)
+# file listing the files/directories (relative to srcdir) to copy, instead of all files in srcdir
+manifest=%(manifest)s
+workers=%(workers)d
+cache=$%(CSUB_SCRATCH_NODE)s/.csub_prestage/%(cachekey)s
+dest=$PWD
+# cache only pays off for a job dir on the node, for one on shared storage it would just be another copy
+if [[ $dest != "$%(CSUB_SCRATCH_NODE)s"/* ]]
+then
+    cache=""
+fi
+
+if [ ! -d  $srcdir ]
 then
-  cp -r $srcdir/* .
-  if [ $? -gt 0 ]
-  then
-      echo "Copying failed ($srcdir to $PWD)"
-      exit 1
-  fi
-else
     echo "Sourcedir $srcdir not found"
     exit 2
 fi
 
+# check whether path $1 matches any of the remaining arguments (patterns)
+matches () {
+    path=$1
+    shift
+    for pattern in "$@"
+    do
+        if [[ $pattern == */* ]]
+        then
+            [[ $path == $pattern ]] && return 0
+        else
+            [[ ${path##*/} == $pattern ]] && return 0
+        fi
+    done
+    return 1
+}
+
+# list paths (relative to srcdir, NUL separated) of all files, symlinks and empty directories to copy
+list_files () {
+    cd $srcdir || return 1
+    if [ -n "$manifest" ]
+    then
+        grep -v '^\\s*$' "$manifest" | while read -r path
+        do
+            find "./${path#./}" \\( -type f -o -type l -o -type d -empty \\) -print0
+        done
+    else
+        find . -mindepth 1 -path './.*' -prune -o \\( -type f -o -type l -o -type d -empty \\) -print0
+    fi | while IFS= read -r -d '' path
+    do
+        path=${path#./}
+        if [ ${#includes[@]} -gt 0 ] && ! matches "$path" "${includes[@]}"
+        then
+            continue
+        fi
+        if matches "$path" "${excludes[@]}"
+        then
+            continue
+        fi
+        printf '%%s\\0' "$path"
+    done
+}
+
+# copy file $1 (relative to srcdir) to cache (unless it is there already), and from cache to current directory:
+# reflink (copy-on-write) if possible, plain copy otherwise (the job may modify any file, so it never shares one
+# with the cache); straight from srcdir without cache
+stage_file () {
+    if [ -d "$srcdir/$1" ] && [ ! -L "$srcdir/$1" ]
+    then
+        mkdir -p "$dest/$1"
+        return
+    fi
+    mkdir -p "`dirname "$dest/$1"`"
+    if [ -L "$srcdir/$1" ]
+    then
+        cp -P "$srcdir/$1" "$dest/$1"
+        return
+    fi
+    if [ -z "$cache" ]
+    then
+        cp -p "$srcdir/$1" "$dest/$1"
+        return
+    fi
+    mkdir -p "`dirname "$cache/$1"`"
+    if [ "`stat -c '%%s %%Y' "$srcdir/$1"`" != "`stat -c '%%s %%Y' "$cache/$1" 2> /dev/null`" ]
+    then
+        cp -p "$srcdir/$1" "$cache/$1.$$" && mv "$cache/$1.$$" "$cache/$1" || return 1
+    fi
+    cp -p --reflink=always "$cache/$1" "$dest/$1" 2> /dev/null && return 0
+    cp -p "$cache/$1" "$dest/$1"
+}
+
+export srcdir cache dest
+export -f stage_file
+
+filelist=`mktemp`
+stage_files () {
+    list_files > $filelist
+    xargs -0 -r -n 16 -P $workers bash -c 'for f in "$@"; do stage_file "$f" || exit 255; done' stage_file < $filelist
+}
+if [ -n "$cache" ]
+then
+    mkdir -p "`dirname $cache`"
+    (
+        # other jobs on this node wait until the cache is up to date, and then only copy from the cache
+        flock 9
+        # register this job as user of the cache (see cleanup_prestage_cache in epilogue)
+        mkdir -p "$cache.jobs" && touch "$cache.jobs/`basename $dest`"
+        stage_files
+    ) 9> "$cache.lock"
+else
+    stage_files
+fi
+if [ $? -gt 0 ]
+then
+    echo "Copying failed ($srcdir to $PWD)"
+    rm -f $filelist
+    exit 1
+fi
+
+# record staged files (<size> <mtime> <path>), so poststage only copies new or changed files
+mkdir -p %(chkptsubdir)s
+xargs -0 -r stat -c '%%s %%Y %%n' < $filelist > %(chkptsubdir)s/prestage.staged
+rm -f $filelist
+
 """
 
 POSTSTAGELOCAL = """#!/bin/bash
 
 # copy all files in this directory recursively
-# no hidden files?
+# no hidden files in top level, no prologue/epilogue and checkpoint directory
+# files copied in by prestage that are unchanged (same size and mtime) are not copied back
 destdir=%(destdir)s/result.$%(CSUB_JOBNAME)s
-mkdir -p $destdir
+# patterns of result files to copy: file name, or path relative to job directory if pattern contains a /
+results=(%(results)s)
+workers=%(workers)d
+# files smaller than this (KB) are packed in a single tarball results.tar in destdir (0: copy all files)
+packsmall=%(packsmall)d
+# files copied in by prestage, see PRESTAGELOCAL (copied next to this script by base)
+staged="`dirname $0`/prestage.staged"
 
-if [ -d  $destdir ]
+mkdir -p $destdir
+if [ ! -d  $destdir ]
 then
-  cp -r * $destdir
-  if [ $? -gt 0 ]
-  then
-      echo "Copying failed ($PWD to $destdir)"
-      exit 1
-  fi
-  # don't copy prologue and epilogue to result directory
-  rm -f $destdir/prologue $destdir/epilogue
-else
     echo "Destdir $destdir not found"
     exit 2
 fi
 
+# check whether path $1 matches any of the remaining arguments (patterns)
+matches () {
+    path=$1
+    shift
+    for pattern in "$@"
+    do
+        if [[ $pattern == */* ]]
+        then
+            [[ $path == $pattern ]] && return 0
+        else
+            [[ ${path##*/} == $pattern ]] && return 0
+        fi
+    done
+    return 1
+}
+
+declare -A unchanged
+if [ -f "$staged" ]
+then
+    while read -r size mtime path
+    do
+        unchanged["$path"]="$size $mtime"
+    done < "$staged"
+fi
+
+# split new or changed files in small files (packed) and other files (copied), NUL separated
+copylist=`mktemp`
+packlist=`mktemp`
+find . -mindepth 1 \\( -path './.*' -o -path ./prologue -o -path ./epilogue -o -path ./%(chkptsubdir)s \\) -prune \\
+    -o \\( -type f -o -type l \\) -printf '%%s %%T@ %%p\\0' | while IFS= read -r -d '' line
+do
+    read -r size mtime path <<< "$line"
+    path=${path#./}
+    if [ ${#results[@]} -gt 0 ] && ! matches "$path" "${results[@]}"
+    then
+        continue
+    fi
+    if [ "${unchanged[$path]}" == "$size ${mtime%%.*}" ]
+    then
+        continue
+    fi
+    if [ $packsmall -gt 0 ] && [ $size -lt $(($packsmall * 1024)) ]
+    then
+        printf '%%s\\0' "$path" >> $packlist
+    else
+        printf '%%s\\0' "$path" >> $copylist
+    fi
+done
+
+export destdir
+xargs -0 -r -n 16 -P $workers bash -c 'for f in "$@"; do
+    mkdir -p "$destdir/`dirname "$f"`" && cp -p -P "$f" "$destdir/$f" || exit 255
+done' copy < $copylist
+ec=$?
+if [ $ec -eq 0 ] && [ -s $packlist ]
+then
+    tar -c -p -f $destdir/results.tar --null -T $packlist
+    ec=$?
+fi
+echo "Copied `tr -cd '\\0' < $copylist | wc -c` files, packed `tr -cd '\\0' < $packlist | wc -c` small files to $destdir"
+rm -f $copylist $packlist
+if [ $ec -gt 0 ]
+then
+    echo "Copying failed ($PWD to $destdir)"
+    exit 1
+fi
+
+"""
+
+# version of format of job state file (see JOB_STATE)
+state_version = 1
+
+# shell functions to read/update the state file of a job (used by base, epilogue and the user checkpoint script):
+# all state of a job that changes while it is running is kept in a single file of <key>=<value> lines, that is
+# replaced atomically (rename) on every update (see read_job_state/update_job_state for Python)
+JOB_STATE = """# print value of key $2 in job state file $1 (empty if not set)
+state_get () {
+    sed -n "s/^$2=//p" "$1" 2> /dev/null
+}
+
+# set keys in job state file $1, remaining arguments are <key>=<value> (an empty value removes the key)
+# concurrent updates are serialized with a lock, the serial number is increased on every update
+state_set () {
+    local f=$1
+    shift
+    (
+        flock 7
+        cat "$f" 2> /dev/null | awk -v version=%d -v upd="$*" '
+            BEGIN { n = split(upd, kv, " "); for (i = 1; i <= n; i++) { k = kv[i]; sub(/=.*/, "", k); v = kv[i]; sub(/^[^=]*=/, "", v); keys[i] = k; new[k] = v } }
+            /^version=/ { next }
+            /^serial=/ { serial = substr($0, 8); next }
+            { k = $0; sub(/=.*/, "", k); if (!(k in new)) { lines[++m] = $0 } }
+            END {
+                print "version=" version
+                print "serial=" serial + 1
+                for (i = 1; i <= m; i++) { print lines[i] }
+                for (i = 1; i <= n; i++) { if (new[keys[i]] != "" && !done[keys[i]]++) { print keys[i] "=" new[keys[i]] } }
+            }' > "$f.new" && mv "$f.new" "$f"
+    ) 2> /dev/null 7>> "$f.lock"
+}
+""" % state_version
+
+# shell function to copy a job dir (used by base and epilogue for array tasks)
+COPY_TREE = """# copy contents of directory $1 into directory $2 as cheaply as possible:
+# reflinks (copy-on-write) if the filesystem supports them, a plain copy otherwise
+# (files are never shared between copies, a task may modify any file of its job dir)
+copy_tree () {
+    mkdir -p "$2"
+    cp -r -p -P --reflink=always "$1/." "$2/" 2> /dev/null || cp -r -p -P "$1/." "$2/"
+}
+"""
+
+# shell functions to check whether data fits in the free space of a filesystem (see --auto_storage, used by base
+# and epilogue)
+STORAGE_SPACE = """# margin (percentage) on expected sizes when comparing with free space
+storage_margin=50
+
+# free space (bytes) on filesystem of directory $1
+free_space () {
+    df -P -B1 "$1" | awk 'NR == 2 { print $4 }'
+}
+
+# whether $1 bytes (with a margin of $storage_margin %) fit in the free space on filesystem of directory $2,
+# sets $need and $free (bytes)
+fits_in () {
+    need=$(($1 * (100 + $storage_margin) / 100))
+    free=`free_space "$2"`
+    [ $need -lt ${free:-0} ]
+}
+"""
+
+# shell function to wait for the rest of a job dir restored after the restart (see --lazy_restore, used by base
+# and epilogue)
+WAIT_FOR_RESTORE = """# wait until job dir is restored completely (see restore_cold in epilogue): marker file $1 holds the pid of
+# the extraction (or 'failed') until it is done; returns 1 if restoring it failed
+wait_for_restore () {
+    if [ ! -f "$1" ]
+    then
+        return 0
+    fi
+    myecho "Waiting until job dir is restored completely `date`"
+    while [ -f "$1" ]
+    do
+        pid=`cat "$1" 2> /dev/null`
+        # failed, or extraction is gone without removing the marker
+        if [ "$pid" == "failed" ] || ( [[ $pid =~ ^[0-9]+$ ]] && ! kill -0 $pid 2> /dev/null && [ -f "$1" ] )
+        then
+            return 1
+        fi
+        sleep 1
+    done
+    myecho "Job dir restored completely `date`"
+}
 """
 
 chkptdirbasebase = os.path.join(
     "%s" % (os.environ[csub_vars_map['CSUB_SCRATCH']]), "chkpt")
 chkptsubdir = "checkpoint"
 tarbfilename = 'job.localdir.tarball'
+# file next to tarball which records the compression codec used
+tarbcodecfilename = '%s.codec' % tarbfilename
+# file next to tarball which records its md5 checksum, verified while unpacking
+tarbsumfilename = '%s.md5' % tarbfilename
 basescriptname = "base"
+# state of job, next to tarball, see JOB_STATE
+statefilename = "chkpt.state"
+# history of checkpoint durations, see chkpt_budget in base
+chkpthistfilename = "chkpt.durations"
+# index of all jobs, one line per state transition, see index_state in base
+# <timestamp> <job id> <job name> <state> <checkpoint count>
+indexfile = os.path.join(chkptdirbasebase, ".index")
+# per-phase timing events of all jobs, one JSON file per job, see metrics_event in base and epilogue
+# {"jobid": <job id>, "cycle": <checkpoint count>, "phase": <phase>, "start": <timestamp>, "end": <timestamp>, "bytes": <int>}
+metricsdir = os.path.join(chkptdirbasebase, ".metrics")
+# deduplicated store of checkpoints (--dedup), see store_pack in epilogue
+storedir = os.path.join(chkptdirbasebase, ".store")
+# queue of directories the epilogue failed to remove, deleted by csub --gc, see remove_dir in epilogue
+# <timestamp> <job id> <directory>
+gcqueuefile = os.path.join(chkptdirbasebase, ".gc")
+# sampling interval (seconds) of resource usage for --vmem=auto without --profile, see profile_sample in base
+default_profile_interval = 60
+# margin (%) on top of peak virtual memory use when requesting virtual memory from profile (--vmem=auto)
+vmem_margin = 20
+# phases which don't contribute to progress of the job
+overhead_phases = ['resubmit', 'restart', 'makechkpt', 'periodic_chkpt', 'pack', 'unpack']
+
+# supported compression codecs for checkpoint tarballs
+# value is the (multi-threaded) compression program passed to tar
+# if adjusted, do so in epilogue too!!
+tar_codecs = {
+    'none': None,
+    'gzip': 'gzip',
+    'pigz': 'pigz',
+    'zstd': 'zstd -T0',
+}
 
 
 def usage():
@@ -138,10 +442,28 @@ def usage():
 
         --pre     Run prestage script (Current: copy local files) [default: no prestage]
 
+        --pre_include=<string>    Only copy files matching these (comma-separated) patterns in prestage, a pattern matches the file name, or the path relative to the job script directory if it contains a / (implies --pre) [default: all files]
+
+        --pre_exclude=<string>    Don't copy files matching these (comma-separated) patterns in prestage, see --pre_include (implies --pre) [default: none]
+
+        --pre_manifest=<string>    Only copy files and directories listed in this file (one path per line, relative to the job script directory) in prestage (implies --pre) [default: all files]
+
+        --pre_workers=<int>    Number of files copied in parallel in prestage [default: 4]
+
         --post    Run poststage script (Current: copy results to localdir/result.) [default: no poststage]
 
+        --post_results=<string>    Only copy files matching these (comma-separated) patterns in poststage, see --pre_include (implies --post) [default: all files]
+
+        --post_workers=<int>    Number of files copied in parallel in poststage [default: 4]
+
+        --post_pack_small=<int>    Pack files smaller than this size (in KB) in a single tarball results.tar in poststage (implies --post) [default: 0, copy all files]
+
         --shared    Run in shared directory (no pro/epilogue, shared checkpoint) [default: run in local dir]
 
+        --auto_storage    Choose between local and shared directory on first start, and between local and shared storage for checkpoint images at every checkpoint, from the expected sizes and the free space (not compatible with --shared) [default: run in local dir]
+
+        --mpi    Checkpoint jobs with several processes (e.g. MPI ranks) on one or more nodes: all processes share one DMTCP coordinator, write their checkpoint images in parallel to local storage of their node, and are restarted on the nodes of the new job (implies --shared, not compatible with --auto_storage) [default: single process]
+
         --no_mimic_pro_epi    Do not mimic prologue/epilogue scripts [default: mimic pro/epi (bug workaround)]
 
         --job_time=<string>    Specify wall time for job (format: <hours>:<minutes>:<seconds>s, e.g. 3:12:47) [default: 10h]
@@ -152,11 +474,55 @@ def usage():
 
         --no_cleanup_chkpt        Don't clean up checkpoint stuff in $%(CSUB_SCRATCH)s/chkpt after job completion [default: do cleanup]
 
-        --resume=<string>        Try to resume a checkpointed job; argument should be unique name of job to resume [default: none]
+        --resume=<string>        Try to resume a checkpointed job; argument should be unique name of job to resume, or a comma-separated list of job names and/or glob patterns to resume a batch of jobs (summary as table, or JSON with --json) [default: none]
 
         --term_kill_mode        Kill checkpointed process with SIGTERM instead of SIGKILL after checkpointing [defailt: SIGKILL]
 
-        --vmem=<string>        Specify amount of virtual memory required [default: none specified]"
+        --vmem=<string>        Specify amount of virtual memory required, or 'auto' to request the peak virtual memory use measured by --profile (plus a margin of 20%%) for every next job [default: none specified]"
+
+        --compress=<string>        Compression codec for checkpoint tarball: none, gzip, pigz or zstd [default: none]
+
+        --incremental=<int>        Only pack changed files as incremental layers on top of the checkpoint tarball, compact into a full tarball after this many layers [default: 0, always full tarball]
+
+        --lazy_restore        Pack checkpoint images and the files needed right after a restart (files that were open or modified) separately from the rest of the job dir, and restart the job before the rest is extracted (in the background) [default: extract complete job dir before restart]
+
+        --lazy_hot=<string>        Files matching these (comma-separated) patterns are always packed with the checkpoint images, see --pre_include (implies --lazy_restore) [default: none]
+
+        --adaptive_chkpt_time        Determine checkpoint time for resubmitted/resumed jobs from history of checkpoint durations [default: always use --chkpt_time]
+
+        --chkpt_mtbf=<string>        Take periodic checkpoints during the job, at the optimal interval for the specified mean time between failures (format: see --job_time), requires --shared or --mpi [default: only checkpoint at end of job]
+
+        --chkpt_generations=<int>        Number of periodic checkpoint generations to keep [default: 2]
+
+        --chkpt_signal=<string>        Comma-separated list of signals (e.g. USR2,TERM) from the scheduler that trigger an immediate checkpoint and resubmit of the job [default: none]
+
+        --chkpt_signal_time=<string>        Ask the scheduler to send the first signal of --chkpt_signal this long before the wall time is up (format: see --job_time) [default: not requested]
+
+        --profile=<string>        Sample resource usage (memory, CPU time, I/O, number of processes) of the checkpointed processes at this interval while the job is running (format: see --job_time) [default: no sampling, every minute with --vmem=auto]
+
+        --prequeue        Submit the next job of a checkpointed job (depending on the current job) right after the job has (re)started rather than at the end of the job, so it is queued while the job is running; it is cancelled if the job completes or fails [default: submit at end of job]
+
+        --status        Show state of all checkpointed jobs [default: no]
+
+        --json        Show output of --status, --report or --gc as JSON [default: no]
+
+        --report=<string>        Show timing of checkpoint/restart phases, checkpoint sizes and queue wait for every job of the specified job name [default: none]
+
+        --bulk=<string>        Submit all jobs listed in the specified manifest file (one job per line: job script followed by csub options for that job), identical jobs are submitted as a single array job; reports results as JSON [default: none]
+
+        --bulk_workers=<int>        Number of jobs to prepare and submit (--bulk), to check and prepare (batch --resume) or directories to remove (--gc) in parallel [default: 8]
+
+        --gc        Remove stale job directories in $%(CSUB_SCRATCH)s/chkpt (see --gc_states and --gc_age, jobs known to the scheduler are never removed) and directories the epilogue failed to remove, in parallel [default: no]
+
+        --gc_age=<string>        Only remove job directories that were not updated for this long (format: see --job_time) [default: 168:0:0]
+
+        --gc_states=<string>        Comma-separated list of last states (see --status) of jobs to remove, use unknown for directories of jobs not in the index [default: complete,killed,failed]
+
+        --gc_dry_run        Only show which directories --gc would remove [default: no]
+
+        --pack_verbosity=<int>        Verbosity of packing/unpacking in prologue/epilogue: 0 (no listings), 1 (size and checksum of tarballs) or 2 (full listings of job dir and tarballs) [default: 1]
+
+        --dedup        Pack checkpoints in deduplicated store $%(CSUB_SCRATCH)s/chkpt/.store shared by all jobs (not compatible with --incremental) [default: tarball per job]
 
 """ % csub_vars_map
 
@@ -200,6 +566,10 @@ def replace_walltime_str(script, wall_time_str):
 def replace_vmem(script, vmem):
     if csub_vars_map['CSUB_SCHEDULER'] == "PBS":
         vmem_regexp = re.compile("^(#PBS -l vmem)=(?P<vmem>.+)\s*(\S*)$", re.MULTILINE)
+        if not vmem_regexp.search(script):
+            # no vmem spec yet, add it after the walltime spec
+            walltime_regexp = re.compile("^(#PBS -l walltime=.*)$", re.MULTILINE)
+            return walltime_regexp.sub(r"\1\n#PBS -l vmem=%s" % vmem, script, 1)
         return vmem_regexp.sub(r"\1=%s \3" % vmem, script)
     else:
         sys.stderr.write("(replace_vmem) Don't know how to handle %s as a job scheduler, sorry.\n")
@@ -276,6 +646,12 @@ def gen_base_header(localmap, script):
 
         localmap.update({'vmem_spec': vmem_spec})
 
+        # advance warning signal before wall time is up (Moab/Torque resource list syntax)
+        signal_spec = ""
+        if localmap.get('chkpt_signal_time') and localmap.get('chkpt_signals'):
+            signal_spec = "#PBS -l signal=SIG%s@%d" % (localmap['chkpt_signals'][0], localmap['chkpt_signal_time'])
+        localmap.update({'signal_spec': signal_spec})
+
         localmap.update({'wall_time_str': gen_wall_time_str(localmap['wall_time'])})
 
         pbs_header_lines = [
@@ -289,6 +665,7 @@ def gen_base_header(localmap, script):
             '%(l_specs)s',
             '%(queue_spec)s',
             '%(vmem_spec)s',
+            '%(signal_spec)s',
         ]
 
         # avoid add empty lines in #PBS header!
@@ -377,25 +754,32 @@ def checkResume(name):
             return (None, None)
         else:
             print "# Job script found @ %s" % jobscript
-            # check for tarball containing checkpoint and intermediary files of job
-            # and for checkpoint file (no tarball in case of --shared)
+            # check for complete tarball containing checkpoint and intermediary files of job (see job state)
+            # and for job state with checkpoint count (no tarball in case of --shared)
             tarbfile = os.path.join(chkptdirbase, chkptsubdir, tarbfilename)
+            statefile = os.path.join(chkptdirbase, chkptsubdir, statefilename)
+            if os.path.isfile(statefile):
+                state = read_job_state(statefile)
+            else:
+                # job checkpointed by an older csub
+                state = read_legacy_job_state(os.path.join(chkptdirbase, chkptsubdir))
+                statefile = os.path.join(chkptdirbase, chkptsubdir, "chkpt.count")
             tarbfilefound = os.path.isfile(tarbfile)
-            chkptfile = os.path.join(chkptdirbase, chkptsubdir, "chkpt.file")
-            chkptfilefound = os.path.isfile(chkptfile)
+            if tarbfilefound and state.get('tarball') != 'ok':
+                print "Tarball for job (%s) is incomplete (packing was interrupted)..." % tarbfile
+                return (None, None)
+            chkptfilefound = not tarbfilefound and 'chkpt' in state
 
             if not tarbfilefound and not chkptfilefound:
                 print "# Tarball for job (%s), which contains checkpoint and intermediate files, not found..." % tarbfile
-                print "# Checkpoint file for job (%s) not found..." % chkptfile
+                print "# Job state with checkpoint count (%s) not found..." % statefile
                 print "# This is ok if job was submitted with --shared."
                 return (None, None)
             else:
                 if tarbfilefound:
                     print "# Job tarball found @ %s" % tarbfile
-                elif chkptfilefound:
-                    print "# Checkpoint file for job found @ %s" % chkptfile
                 else:
-                    sys.stderr.write("ERROR! Neither job tarball (%s) nor checkpoint file (%s) found. Huh?\n" % (tarbfile, chkptfile))
+                    print "# Job state found @ %s (checkpoint %s)" % (statefile, state['chkpt'])
 
                 # check for base script
                 basescript = os.path.join(
@@ -408,7 +792,746 @@ def checkResume(name):
                     return (basescript, arrayid)
 
 
-def submitbase(base, name):
+# prepare resuming job with specified name: check checkpoint of job, adjust job time/checkpoint time/vmem
+# in base script (see --job_time, --chkpt_time and --vmem, with --vmem=auto from the profile of the job),
+# and take backup of output files of previous run
+# returns (base script, array spec), or (None, None) if job can't be resumed
+def prepare_resume(name, options):
+
+    job_time_spec = options['job_time_spec']
+    job_time = options['job_time']
+    chkpt_time_spec = options['chkpt_time_spec']
+    chkpt_time = options['chkpt_time']
+    vmem = options['vmem']
+    auto_vmem = options['auto_vmem']
+
+    # check whether job with specified name can be resumed
+    (base, arrayid) = checkResume(name)
+
+    if base:
+        # make sure it also works correctly for array jobs
+        arrayspec = None
+        if arrayid:
+            arrayspec = arrayid
+
+        try:
+            f = open(base, "r")
+            basetxt = f.read()
+            f.close()
+        except IOError as err:
+            sys.stderr.write("Failed to read base script %s: %s\n" % (base, err))
+            sys.exit(1)
+
+        # determine chkpt_time from history for jobs submitted with --adaptive_chkpt_time
+        if not chkpt_time_spec and re.search("^adaptive_chkpt_time=1\s*$", basetxt, re.MULTILINE):
+            budget = get_chkpt_budget(os.path.dirname(base))
+            if budget:
+                print "# Checkpoint time based on history: %d seconds" % budget
+                chkpt_time = budget
+                chkpt_time_spec = True
+
+        # virtual memory based on peak use measured by --profile
+        profile_vmem = get_profile_vmem(read_job_state(os.path.join(os.path.dirname(base), statefilename)))
+        if auto_vmem:
+            if profile_vmem:
+                print "# Virtual memory based on profile: %s" % profile_vmem
+                vmem = profile_vmem
+            else:
+                print "# No profile of job available yet, virtual memory is determined once it is profiled"
+            # keep requesting virtual memory based on profile for subsequent jobs
+            basetxt = re.sub("(?m)^auto_vmem=0\s*$", "auto_vmem=1", basetxt)
+            basetxt = re.sub("(?m)^profile_interval=0\s*$", "profile_interval=%d" % default_profile_interval, basetxt)
+        elif profile_vmem and not vmem:
+            print "# Peak virtual memory use of job (plus %d%%): %s, use --vmem=auto to request it" % (vmem_margin, profile_vmem)
+
+        # change job time and/or chkpt_time before resubmitting
+        if job_time_spec or chkpt_time_spec or vmem or auto_vmem:
+            walltime_script = get_wall_time(basetxt)
+
+            job_time_regexp = re.compile(
+                "^(chksltot)=(?P<job_time>[0-9]+)\s*(\S*)$", re.MULTILINE)
+            job_time_script = int(
+                job_time_regexp.search(basetxt).group('job_time'))
+
+            if job_time_spec:
+                new_job_time = job_time
+            else:
+                new_job_time = job_time_script
+
+            if chkpt_time_spec:
+                new_chkpt_time = chkpt_time
+            else:
+                new_chkpt_time = walltime_script - job_time_script
+
+            wall_time_str = gen_wall_time_str(
+                new_job_time + new_chkpt_time)
+
+            basetxt = job_time_regexp.sub(
+                r"\1=%d \3\n" % new_job_time, basetxt)
+            basetxt = replace_walltime_str(basetxt, wall_time_str)
+
+            if vmem:
+                basetxt = replace_vmem(basetxt, vmem)
+
+            try:
+                f = open(base, "w")
+                f.write(basetxt)
+                f.close()
+            except Exception, err:
+                sys.stderr.write("Failed to backup/rewrite base script %s when adjusting job_time/chkpt_time: %s\n" % (base, err))
+                sys.exit(1)
+
+        outputfiles = re.compile("^\s*#PBS\s+-o\s+(?P<chkptdirbase>\S+)/(?P<name>[^/]+).base.out\s*$", re.MULTILINE).search(basetxt).groupdict()
+        tomove = []
+
+        if arrayid:
+            outputfiles["arrayid"] = arrayid
+            tomove.append("%(chkptdirbase)s-%(arrayid)s/%(name)s-%(arrayid)s.out" % outputfiles)
+            tomove.append("%(chkptdirbase)s-%(arrayid)s/%(name)s-%(arrayid)s.err" % outputfiles)
+            tomove.append("%(chkptdirbase)s/%(name)s.base.out-%(arrayid)s" % outputfiles)
+            tomove.append("%(chkptdirbase)s/%(name)s.base.err-%(arrayid)s" % outputfiles)
+        else:
+            tomove.append("%(chkptdirbase)s/%(name)s.out" % outputfiles)
+            tomove.append("%(chkptdirbase)s/%(name)s.err" % outputfiles)
+            tomove.append("%(chkptdirbase)s/%(name)s.base.out" % outputfiles)
+            tomove.append("%(chkptdirbase)s/%(name)s.base.err" % outputfiles)
+
+        for filename in tomove:
+            try:
+                print "Taking backup of output file %s" % filename
+                shutil.copy2(filename, "%s.prev" % filename)
+            except OSError as err:
+                sys.stderr.write("Failed to rename the log output of the previous run: %s\n" % filename)
+                sys.exit(1)
+
+        return (base, arrayspec)
+
+    return (None, None)
+
+
+# expand comma-separated list of job names and/or glob patterns (matched with checkpointed jobs) for --resume
+def expand_resume_names(spec):
+    import fnmatch
+
+    try:
+        existing = [x for x in os.listdir(chkptdirbasebase) if not x.startswith('.')]
+    except OSError, err:
+        sys.stderr.write("Failed to list checkpointed jobs in %s: %s\n" % (chkptdirbasebase, err))
+        sys.exit(1)
+
+    names = []
+    for pattern in [x for x in spec.split(',') if x]:
+        if not re.search(r'[*?\[]', pattern):
+            matched = [pattern]
+        else:
+            matched = sorted(fnmatch.filter(existing, pattern))
+            # initial directory of array job can't be resumed, only its array tasks
+            tasks = re.compile("^(?P<name>.*)%s\d+$" % csub_vars_map['CSUB_ARRAY_SEP'])
+            initial = set([m.group('name') for m in [tasks.match(x) for x in matched] if m])
+            matched = [x for x in matched if x not in initial]
+            if not matched:
+                sys.stderr.write("No checkpointed jobs found matching %s\n" % pattern)
+        names.extend([x for x in matched if x not in names])
+
+    return names
+
+
+# call fun for every item in items, in parallel in a pool of (at most) workers threads
+# output goes to stderr meanwhile, to keep stdout clean for the summary or JSON report of the caller
+# returns list of return values of fun, in the order of items
+def run_parallel(fun, items, workers):
+    import threading
+    import Queue
+
+    todo = Queue.Queue()
+    for item in enumerate(items):
+        todo.put(item)
+    results = [None] * len(items)
+
+    def worker():
+        while True:
+            try:
+                (idx, item) = todo.get_nowait()
+            except Queue.Empty:
+                return
+            results[idx] = fun(item)
+
+    stdout = sys.stdout
+    sys.stdout = sys.stderr
+    threads = [threading.Thread(target=worker) for _ in range(min(workers, len(items)))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    sys.stdout = stdout
+
+    return results
+
+
+# resume batch of jobs: checkpoints of all jobs are checked and prepared in parallel (see prepare_resume),
+# and all jobs are submitted in one go (see submitbases)
+# reports result for every job as a table, or as JSON
+def resume_jobs(names, options):
+
+    if not names:
+        sys.stderr.write("No jobs to resume.\n")
+        sys.exit(1)
+
+    results = dict([(name, {'name': name, 'status': 'failed'}) for name in names])
+
+    def prepare(name):
+        try:
+            (base, arrayspec) = prepare_resume(name, options)
+            if not base:
+                results[name]['error'] = 'checkpoint not found'
+        except SystemExit, err:
+            (base, arrayspec) = (None, None)
+            results[name]['error'] = 'preparing resume failed (exit code %s)' % err.code
+        except Exception, err:
+            (base, arrayspec) = (None, None)
+            results[name]['error'] = str(err)
+        return (base, arrayspec)
+
+    prepared = dict([(name, x) for (name, x) in zip(names, run_parallel(prepare, names, options['bulk_workers']))
+                     if x[0]])
+
+    tosubmit = [x for x in names if x in prepared]
+    submitted = submitbases([prepared[x] for x in tosubmit])
+    for (name, (ec, out)) in zip(tosubmit, submitted):
+        if ec == 0:
+            results[name]['status'] = 'resumed'
+            results[name]['jobid'] = out
+            index_state(name, 'resumed', out)
+        else:
+            results[name]['error'] = 'submission failed (exit code %s): %s' % (ec, out)
+
+    if options['json']:
+        import json
+        print json.dumps([results[x] for x in names], indent=4)
+    else:
+        fmt = "%-40s %-8s %s"
+        print fmt % ("name", "status", "job id / error")
+        for name in names:
+            result = results[name]
+            print fmt % (name, result['status'], result.get('jobid', result.get('error', '')))
+        print
+        print "%d of %d jobs resumed" % (len([x for x in results.values() if x['status'] == 'resumed']), len(names))
+
+    if [x for x in results.values() if x['status'] != 'resumed']:
+        sys.exit(1)
+
+
+# predict time required for checkpointing (in seconds) from history of checkpoint durations
+# same logic as chkpt_budget in base: largest total duration over last jobs (or time to write images of peak
+# memory use at measured checkpoint rate, if job was profiled), plus safety margin
+# returns None if no history is available
+def get_chkpt_budget(chkptdir, last=5):
+
+    histfile = os.path.join(chkptdir, chkpthistfilename)
+    if not os.path.isfile(histfile):
+        return None
+
+    totals = {}
+    jobs = []
+    try:
+        for line in open(histfile).readlines():
+            fields = line.split()
+            if len(fields) != 3:
+                continue
+            if fields[0] not in totals:
+                jobs.append(fields[0])
+                totals[fields[0]] = 0
+            totals[fields[0]] += int(fields[2])
+    except (IOError, ValueError), err:
+        sys.stderr.write("Failed to read checkpoint duration history %s: %s\n" % (histfile, err))
+        return None
+
+    if not jobs:
+        return None
+
+    mem_time = 0
+    state = read_job_state(os.path.join(chkptdir, statefilename))
+    try:
+        if int(state.get('chkpt_rate', 0)) > 0 and 'peak_rss' in state:
+            mem_time = int(state['peak_rss']) / int(state['chkpt_rate'])
+    except ValueError:
+        pass
+
+    return int(max([mem_time] + [totals[x] for x in jobs[-last:]]) * 1.5) + 60
+
+
+# virtual memory to request (e.g. 1200mb) for job, from peak virtual memory use in its state (see --profile)
+# plus margin, same logic as profile_vmem in base
+# returns None if job was not profiled
+def get_profile_vmem(state):
+    try:
+        peak = int(state['peak_vsz'])
+    except (KeyError, ValueError):
+        return None
+    return "%dmb" % ((peak * (100 + vmem_margin) / 100 + 1024 ** 2 - 1) / 1024 ** 2)
+
+
+# add state transition for job to index of all jobs
+def index_state(name, state, jobid, count=0):
+    import time
+
+    try:
+        # single write in append mode, so lines of concurrent writers are not mixed up
+        f = open(indexfile, 'a')
+        f.write("%d %s %s %s %d\n" % (time.time(), jobid.split()[0] if jobid else '-', name, state, count))
+        f.close()
+    except IOError, err:
+        sys.stderr.write("Failed to update job index %s: %s\n" % (indexfile, err))
+
+
+# read state file of job (see JOB_STATE), returns dict (empty if there is no state file)
+def read_job_state(fn):
+    state = {}
+    try:
+        for line in open(fn).readlines():
+            if '=' in line:
+                (key, value) = line.rstrip('\n').split('=', 1)
+                state[key] = value
+    except IOError:
+        return state
+
+    if int(state.get('version', 0)) > state_version:
+        sys.stderr.write("WARNING: state file %s was written by a newer version of csub\n" % fn)
+    return state
+
+
+# job state of a job checkpointed by an older csub, which had no state file but separate files in checkpoint
+# directory chkdir: an .ok marker next to the complete tarball, and the checkpoint count in chkpt.count
+def read_legacy_job_state(chkdir):
+    state = {}
+    if os.path.isfile(os.path.join(chkdir, "%s.ok" % tarbfilename)):
+        state['tarball'] = 'ok'
+    try:
+        state['chkpt'] = open(os.path.join(chkdir, "chkpt.count")).read().strip()
+    except IOError:
+        pass
+    return state
+
+
+# set keys in state file of job atomically, like state_set in JOB_STATE (a value None removes the key)
+def update_job_state(fn, **updates):
+    import fcntl
+
+    try:
+        lock = open("%s.lock" % fn, 'a')
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        state = read_job_state(fn)
+        state.update(updates)
+        state['serial'] = int(state.get('serial', 0)) + 1
+        state['version'] = state_version
+        f = open("%s.new" % fn, 'w')
+        f.write("version=%d\nserial=%d\n" % (state.pop('version'), state.pop('serial')))
+        f.write(''.join(["%s=%s\n" % (key, state[key]) for key in sorted(state.keys()) if state[key] is not None]))
+        f.close()
+        os.rename("%s.new" % fn, fn)
+        lock.close()
+    except IOError, err:
+        sys.stderr.write("Failed to update job state %s: %s\n" % (fn, err))
+        sys.exit(1)
+
+
+# read index of all jobs, returns dict with last state for every job name
+def read_index():
+
+    jobs = {}
+    if not os.path.isfile(indexfile):
+        return jobs
+
+    try:
+        for line in open(indexfile).readlines():
+            fields = line.split()
+            if len(fields) != 5:
+                continue
+            (timestamp, jobid, name, state, count) = fields
+            job = jobs.setdefault(name, {'name': name, 'cycles': 0})
+            job.update({
+                'jobid': jobid,
+                'state': state,
+                'time': int(timestamp),
+                'cycles': max(job['cycles'], int(count)),
+            })
+    except (IOError, ValueError), err:
+        sys.stderr.write("Failed to read job index %s: %s\n" % (indexfile, err))
+        sys.exit(1)
+
+    return jobs
+
+
+# get state of all jobs known to the scheduler with a single query
+# returns dict with job id (without server name) as key, scheduler state as value
+# returns None if the scheduler could not be queried
+def get_scheduler_jobs():
+
+    if csub_vars_map['CSUB_SCHEDULER'] == "PBS":
+        try:
+            p = popen2.Popen3('qstat -t')
+            p.tochild.close()
+            out = p.fromchild.read()
+            ec = p.wait()
+        except Exception, err:
+            sys.stderr.write("Something went wrong with forking qstat: %s\n" % err)
+            return None
+
+        if ec > 0:
+            sys.stderr.write("qstat failed: exitcode %s\n" % ec)
+            return None
+
+        jobs = {}
+        for line in out.splitlines()[2:]:
+            fields = line.split()
+            if len(fields) >= 6:
+                jobs[fields[0].split('.')[0]] = fields[4]
+        return jobs
+
+    else:
+        sys.stderr.write("(get_scheduler_jobs) Don't know how to handle %s as a job scheduler, sorry.\n")
+        sys.exit(1)
+
+
+# show state of all jobs in index, as a table or as JSON
+def show_status(as_json):
+    import time
+
+    jobs = read_index()
+    scheduler_jobs = get_scheduler_jobs() or {}
+
+    for job in jobs.values():
+        job['scheduler_state'] = scheduler_jobs.get(job['jobid'].split('.')[0], None)
+
+    names = sorted(jobs.keys())
+    if as_json:
+        import json
+        print json.dumps([jobs[x] for x in names], indent=4)
+    else:
+        fmt = "%-40s %-15s %-6s %-20s %-5s %s"
+        print fmt % ("name", "state", "cycles", "job id", "sched", "last update")
+        for name in names:
+            job = jobs[name]
+            print fmt % (name, job['state'], job['cycles'], job['jobid'], job['scheduler_state'] or '-',
+                         time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(job['time'])))
+
+
+# read timing events of job (and its array tasks), returns list of events sorted by time
+# every event is tagged with the name of the (array) job it belongs to
+def read_metrics(name):
+    import glob
+    import json
+
+    events = []
+    for fn in glob.glob(os.path.join(metricsdir, "%s.jsonl" % name)) + \
+            glob.glob(os.path.join(metricsdir, "%s-[0-9]*.jsonl" % name)):
+        try:
+            for line in open(fn).readlines():
+                if not line.strip():
+                    continue
+                try:
+                    event = json.loads(line)
+                except ValueError:
+                    # partially written line of job that was killed, ignore it
+                    continue
+                event['name'] = os.path.basename(fn)[:-len('.jsonl')]
+                events.append(event)
+        except IOError, err:
+            sys.stderr.write("Failed to read metrics %s: %s\n" % (fn, err))
+            sys.exit(1)
+
+    events.sort(key=lambda x: (x['start'], x['end']))
+    return events
+
+
+# aggregate timing events per job (i.e. per checkpoint/restart cycle)
+# queue wait is the time between the end of the previous job and the start of the next one
+def aggregate_metrics(events):
+
+    jobs = []
+    byid = {}
+    for event in events:
+        if event['jobid'] not in byid:
+            byid[event['jobid']] = {
+                'name': event['name'],
+                'jobid': event['jobid'],
+                'cycle': event['cycle'],
+                'start': event['start'],
+                'end': event['end'],
+                'phases': {},
+                'bytes': 0,
+                'overhead': 0,
+                'queue_wait': None,
+            }
+            jobs.append(byid[event['jobid']])
+        job = byid[event['jobid']]
+        job['start'] = min(job['start'], event['start'])
+        job['end'] = max(job['end'], event['end'])
+        job['cycle'] = max(job['cycle'], event['cycle'])
+        if event['phase'] == 'start':
+            continue
+        duration = event['end'] - event['start']
+        job['phases'][event['phase']] = job['phases'].get(event['phase'], 0) + duration
+        job['bytes'] += event['bytes']
+        if event['phase'] in overhead_phases:
+            job['overhead'] += duration
+
+    # array tasks are separate chains of jobs, only consecutive jobs of the same task are compared
+    last = {}
+    for job in jobs:
+        prev = last.get(job['name'])
+        if prev is not None and job['start'] >= prev['end']:
+            job['queue_wait'] = job['start'] - prev['end']
+        last[job['name']] = job
+
+    return jobs
+
+
+# show timing report for all jobs of job name, as a table or as JSON
+def show_report(name, as_json):
+
+    jobs = aggregate_metrics(read_metrics(name))
+    if not jobs:
+        sys.stderr.write("No metrics found for job %s in %s\n" % (name, metricsdir))
+        sys.exit(1)
+
+    if as_json:
+        import json
+        print json.dumps(jobs, indent=4)
+        return
+
+    phases = ['unpack', 'restart', 'firststart', 'chkptsleep', 'periodic_chkpt', 'makechkpt', 'pack', 'resubmit']
+    fmt = "%-30s %-20s %-5s" + " %10s" * (len(phases) + 3)
+    print fmt % tuple(["name", "job id", "cycle"] + phases + ["overhead", "queue wait", "bytes"])
+    for job in jobs:
+        values = [job['phases'].get(x, '-') for x in phases]
+        queue_wait = job['queue_wait']
+        if queue_wait is None:
+            queue_wait = '-'
+        print fmt % tuple([job['name'], job['jobid'], job['cycle']] + values + [job['overhead'], queue_wait, job['bytes']])
+
+    total = sum([x['end'] - x['start'] for x in jobs])
+    overhead = sum([x['overhead'] for x in jobs])
+    waits = [x['queue_wait'] for x in jobs if x['queue_wait'] is not None]
+    print
+    print "total run time %ds, overhead %ds (%.1f%%), queue wait %ds" % (
+        total, overhead, 100.0 * overhead / max(total, 1), sum(waits))
+
+
+# job id without server name and array index, to match jobs of the index with jobs known to the scheduler
+def jobid_base(jobid):
+    return jobid.split('.')[0].split('[')[0]
+
+
+# find stale job directories in chkptdirbasebase: last state (see read_index) in states, last update
+# (in index, or of the directory) at least max_age seconds ago, and no job known to the scheduler (scheduler_jobs)
+# initial directories of array jobs are orphaned once no directories of array tasks are left
+# returns list of dicts with name, path, state, age and job id
+def find_stale_jobs(max_age, states, scheduler_jobs):
+    import time
+
+    try:
+        names = [x for x in os.listdir(chkptdirbasebase) if not x.startswith('.')]
+    except OSError, err:
+        sys.stderr.write("Failed to list checkpointed jobs in %s: %s\n" % (chkptdirbasebase, err))
+        sys.exit(1)
+
+    jobs = read_index()
+    active = set([jobid_base(x) for (x, state) in scheduler_jobs.items() if state != 'C'])
+    tasks = re.compile("^(?P<name>.*)%s\d+$" % csub_vars_map['CSUB_ARRAY_SEP'])
+    now = time.time()
+
+    stale = []
+    for name in sorted(names):
+        path = os.path.join(chkptdirbasebase, name)
+        if not os.path.isdir(path):
+            continue
+        # index entries of job itself, and of its array tasks (if any)
+        related = [x for x in jobs.values() if x['name'] == name or
+                   (tasks.match(x['name']) and tasks.match(x['name']).group('name') == name)]
+        if [x for x in related if jobid_base(x['jobid']) in active]:
+            continue
+        age = now - max([os.path.getmtime(path)] + [x['time'] for x in related])
+        if age < max_age:
+            continue
+        if [x for x in related if x['name'] != name]:
+            if [x for x in names if tasks.match(x) and tasks.match(x).group('name') == name]:
+                continue
+            state = 'orphaned'
+        elif name in jobs:
+            state = jobs[name]['state']
+            if state not in states:
+                continue
+        elif 'unknown' in states:
+            state = 'unknown'
+        else:
+            continue
+        stale.append({'name': name, 'path': path, 'state': state, 'age': int(age),
+                      'jobid': name in jobs and jobs[name]['jobid'] or '-'})
+
+    return stale
+
+
+# remove reference of job to checkpoint chunks in deduplicated store, and chunks no other job refers to
+# (see store_release in epilogue)
+def store_release(name):
+
+    for ref in [os.path.join(storedir, 'refs', name + x) for x in ['', '.new', '.old']]:
+        if not os.path.isdir(ref):
+            continue
+        for chunk in os.listdir(ref):
+            obj = os.path.join(storedir, 'objects', chunk[:2], chunk)
+            os.remove(os.path.join(ref, chunk))
+            try:
+                if os.stat(obj).st_nlink == 1:
+                    os.remove(obj)
+            except OSError:
+                pass
+        os.rmdir(ref)
+
+
+# delete stale job directories (see find_stale_jobs) and directories queued by epilogue in parallel
+# directories that can't be removed are queued again for the next run
+# reports result for every directory as a table, or as JSON
+def collect_garbage(options):
+    import shutil
+    import time
+
+    # jobs known to the scheduler are never removed, so don't remove anything if it can't tell which ones it knows
+    scheduler_jobs = get_scheduler_jobs()
+    if scheduler_jobs is None:
+        sys.stderr.write("Can't get jobs from scheduler, not removing anything.\n")
+        sys.exit(1)
+
+    # take over current queue, epilogues that fail to remove a directory meanwhile start a new one
+    queue = []
+    taken = "%s.%d" % (gcqueuefile, os.getpid())
+    if os.path.isfile(gcqueuefile) and not options['gc_dry_run']:
+        try:
+            os.rename(gcqueuefile, taken)
+            queue = open(taken).readlines()
+        except (IOError, OSError), err:
+            sys.stderr.write("Failed to read deletion queue %s: %s\n" % (gcqueuefile, err))
+            sys.exit(1)
+    elif os.path.isfile(gcqueuefile):
+        queue = open(gcqueuefile).readlines()
+
+    todo = []
+    paths = set()
+    for line in queue:
+        fields = line.split()
+        if len(fields) != 3:
+            continue
+        (timestamp, jobid, path) = fields
+        # never remove anything outside of checkpoint directory
+        if os.path.dirname(os.path.realpath(path)) != os.path.realpath(chkptdirbasebase) or path in paths:
+            continue
+        paths.add(path)
+        todo.append({'name': os.path.basename(path), 'path': path, 'state': 'queued',
+                     'age': int(time.time()) - int(timestamp), 'jobid': jobid})
+    for job in find_stale_jobs(options['gc_age'], options['gc_states'], scheduler_jobs):
+        if job['path'] not in paths:
+            paths.add(job['path'])
+            todo.append(job)
+
+    if options['gc_dry_run']:
+        for job in todo:
+            job['status'] = 'stale'
+    else:
+        def remove(job):
+            try:
+                if os.path.exists(job['path']):
+                    shutil.rmtree(job['path'])
+                # (epilogue already released the store references of directories it queued)
+                if job['state'] != 'queued':
+                    store_release(job['name'])
+                job['status'] = 'removed'
+            except (IOError, OSError), err:
+                job['status'] = 'failed'
+                job['error'] = str(err)
+
+        run_parallel(remove, todo, options['bulk_workers'])
+
+        failed = [x for x in todo if x['status'] == 'failed']
+        try:
+            if failed:
+                f = open(gcqueuefile, 'a')
+                f.write(''.join(["%d %s %s\n" % (time.time(), x['jobid'], x['path']) for x in failed]))
+                f.close()
+            if queue:
+                os.remove(taken)
+        except (IOError, OSError), err:
+            sys.stderr.write("Failed to update deletion queue %s: %s\n" % (gcqueuefile, err))
+        for job in todo:
+            if job['status'] == 'removed' and job['state'] != 'queued':
+                index_state(job['name'], 'removed', job['jobid'])
+
+    if options['json']:
+        import json
+        print json.dumps(todo, indent=4)
+    else:
+        fmt = "%-40s %-10s %-10s %-8s %s"
+        print fmt % ("name", "state", "age (h)", "status", "error")
+        for job in todo:
+            print fmt % (job['name'], job['state'], job['age'] / 3600, job['status'], job.get('error', ''))
+        print
+        print "%d of %d directories %s" % (len([x for x in todo if x['status'] != 'failed']), len(todo),
+                                           options['gc_dry_run'] and 'stale' or 'removed')
+
+    if [x for x in todo if x['status'] == 'failed']:
+        sys.exit(1)
+
+
+# estimate size (bytes) of work dir of job: files in job directory, and files copied by prestage
+# (same selection of files as list_files in PRESTAGELOCAL)
+def estimate_workdir_bytes(chkptdirbase, parent_dir, options):
+    import fnmatch
+
+    def matches(path, patterns):
+        for pattern in patterns:
+            if '/' in pattern:
+                if fnmatch.fnmatch(path, pattern):
+                    return True
+            elif fnmatch.fnmatch(os.path.basename(path), pattern):
+                return True
+        return False
+
+    # sizes of all files in directory tree top (or of top itself), with path relative to base
+    def tree_sizes(base, top, prune_hidden=False):
+        if not os.path.isdir(top):
+            if os.path.lexists(top):
+                yield (os.path.relpath(top, base), os.lstat(top).st_size)
+            return
+        for (dirpath, dirnames, filenames) in os.walk(top):
+            if prune_hidden and dirpath == top:
+                dirnames[:] = [x for x in dirnames if not x.startswith('.')]
+                filenames = [x for x in filenames if not x.startswith('.')]
+            for filename in filenames:
+                path = os.path.join(dirpath, filename)
+                yield (os.path.relpath(path, base), os.lstat(path).st_size)
+
+    total = sum([size for (_, size) in tree_sizes(chkptdirbase, chkptdirbase)])
+
+    if options['prestage']:
+        if options['pre_manifest']:
+            paths = [x.strip() for x in open(options['pre_manifest']).readlines() if x.strip()]
+            files = []
+            for path in paths:
+                files.extend(tree_sizes(parent_dir, os.path.join(parent_dir, path)))
+        else:
+            files = tree_sizes(parent_dir, parent_dir, prune_hidden=True)
+        for (path, size) in files:
+            if options['pre_include'] and not matches(path, options['pre_include']):
+                continue
+            if matches(path, options['pre_exclude']):
+                continue
+            total += size
+
+    return total
+
+
+# submit base script, returns output of submission (job id)
+def submitbase(base, name, arrayspec):
 
     if csub_vars_map['CSUB_SCHEDULER'] == "PBS":
 
@@ -431,16 +1554,64 @@ def submitbase(base, name):
             sys.exit(1)
 
         print "Job with name %s succesfully submitted" % (name)
+        return out.strip()
 
     else:
         sys.stderr.write("ERROR! (in submitbase) Don't know how to handle %s as a job scheduler, sorry.\n")
         sys.exit(1)
 
 
+# submit list of base scripts (with array spec) in one go: all submissions are done by a single shell
+# returns list of (exit code, output of submission) for every base script
+def submitbases(bases):
+
+    if not bases:
+        return []
+
+    if csub_vars_map['CSUB_SCHEDULER'] == "PBS":
+
+        # one line of output per submission: <index> <exit code> <output>
+        cmds = []
+        for (idx, (base, arrayspec)) in enumerate(bases):
+            arrayoption = ""
+            if arrayspec:
+                arrayoption = "-t %s" % arrayspec
+            cmds.append('out=`qsub %s %s 2>&1`; echo "%d $?" `echo $out`' % (arrayoption, pipes.quote(base), idx))
+
+        try:
+            p = popen2.Popen4('\n'.join(cmds))
+            p.tochild.close()  # no input
+            out = p.fromchild.read()  # read output
+            p.wait()
+        except Exception, err:
+            sys.stderr.write("Something went wrong with forking qsub: %s\n" % err)
+            sys.exit(1)
+
+        results = [(1, 'no output from qsub')] * len(bases)
+        for line in out.splitlines():
+            fields = line.split(' ', 2)
+            if len(fields) >= 2 and fields[0].isdigit() and fields[1].isdigit() and int(fields[0]) < len(bases):
+                results[int(fields[0])] = (int(fields[1]), ' '.join(fields[2:]).strip())
+        return results
+
+    else:
+        sys.stderr.write("ERROR! (in submitbases) Don't know how to handle %s as a job scheduler, sorry.\n" % csub_vars_map['CSUB_SCHEDULER'])
+        sys.exit(1)
+
+
 # prepare checkpoint directory tree, prestage/poststrage scripts, prologue/epilogue, job script,
-def runall(scriptname, parent_dir, script, job_time, chkpt_time, prestage, poststage, shared, queue, mimic_pro_epi, cleanup_after_restart, vmem):
+# job options are passed as a dict (see parse_options)
+# returns output of submission (job id)
+def runall(scriptname, parent_dir, script, options):
     global EPILOGUE, BASE, PRESTAGELOCAL, POSTSTAGELOCAL
 
+    job_time = options['job_time']
+    chkpt_time = options['chkpt_time']
+    prestage = options['prestage']
+    poststage = options['poststage']
+    shared = options['shared']
+    compress = options['compress']
+
     # make the directory
 
     # make sure csub_vars_map['CSUB_SCRATCH'] environment variable is there
@@ -463,10 +1634,32 @@ def runall(scriptname, parent_dir, script, job_time, chkpt_time, prestage, posts
         sys.exit(1)
 
     # make the scripts
+    prestage_cachekey = ""
     if prestage:
         prestagefile = "%s/prestage" % (chkptdir)
         if prestage == 'local':
-            prestagetxt = PRESTAGELOCAL % {'srcdir': parent_dir}
+            prestage_cachekey = hashlib.md5(parent_dir).hexdigest()
+            manifest = ""
+            if options['pre_manifest']:
+                # keep copy of manifest with job, like the job script
+                manifest = os.path.join(chkptdir, "prestage.manifest")
+                try:
+                    shutil.copy(options['pre_manifest'], manifest)
+                except (IOError, OSError), err:
+                    sys.stderr.write("Can't copy prestage manifest %s: %s\n" % (options['pre_manifest'], err))
+                    sys.exit(1)
+            localmap = {
+                'srcdir': parent_dir,
+                'chkptsubdir': chkptsubdir,
+                'includes': ' '.join([pipes.quote(x) for x in options['pre_include']]),
+                'excludes': ' '.join([pipes.quote(x) for x in options['pre_exclude']]),
+                'manifest': manifest,
+                'workers': options['pre_workers'],
+                # one cache per source directory
+                'cachekey': prestage_cachekey,
+            }
+            localmap.update(csub_vars_map)
+            prestagetxt = PRESTAGELOCAL % localmap
 
         try:
             file(prestagefile, 'w').write(prestagetxt)
@@ -478,7 +1671,13 @@ def runall(scriptname, parent_dir, script, job_time, chkpt_time, prestage, posts
     if poststage:
         poststagefile = "%s/poststage" % (chkptdir)
         if poststage == 'local':
-            localmap = {'destdir': parent_dir}
+            localmap = {
+                'destdir': parent_dir,
+                'chkptsubdir': chkptsubdir,
+                'results': ' '.join([pipes.quote(x) for x in options['post_results']]),
+                'workers': options['post_workers'],
+                'packsmall': options['post_pack_small'],
+            }
             localmap.update(csub_vars_map)
             poststagetxt = POSTSTAGELOCAL % localmap
 
@@ -499,6 +1698,21 @@ def runall(scriptname, parent_dir, script, job_time, chkpt_time, prestage, posts
         sys.stderr.write("Can't create jobscript file %s:%s\n" % (jobscript, err))
         sys.exit(1)
 
+    # expected size of work dir and checkpoint images (from --vmem), to choose storage (see --auto_storage)
+    workdir_bytes = 0
+    image_estimate = 0
+    if options['auto_storage']:
+        workdir_bytes = estimate_workdir_bytes(chkptdirbase, parent_dir, options)
+        if options['vmem']:
+            image_estimate = parsesize(options['vmem']) or 0
+        stat = os.statvfs(chkptdirbasebase)
+        free = stat.f_bavail * stat.f_frsize
+        print "# Expected size of work dir: %d MB, of checkpoint images: %d MB (%d MB free on shared storage)" % \
+            (workdir_bytes / 1024 ** 2, image_estimate / 1024 ** 2, free / 1024 ** 2)
+        if workdir_bytes + image_estimate > free:
+            sys.stderr.write("WARNING: not enough free space on shared storage %s for work dir and checkpoint images\n"
+                             % chkptdirbasebase)
+
     # prepare prologue and epilogue scripts
     epilogue_script = ""
     prologue_script = ""
@@ -507,7 +1721,15 @@ def runall(scriptname, parent_dir, script, job_time, chkpt_time, prestage, posts
         epilogue_script = "%s/epilogue" % chkptdirbase
         prologue_script = "%s/prologue" % chkptdirbase
         try:
-            epiloguetxt = EPILOGUE % csub_vars_map
+            localmap = {'tar_codec': compress, 'incremental': options['incremental'], 'dedup': options['dedup'],
+                        'pack_verbosity': options['pack_verbosity'], 'auto_storage': options['auto_storage'],
+                        'workdir_bytes': workdir_bytes, 'image_estimate': image_estimate, 'job_state': JOB_STATE,
+                        'copy_tree': COPY_TREE, 'wait_for_restore': WAIT_FOR_RESTORE, 'storage_space': STORAGE_SPACE,
+                        'prestage_cachekey': prestage_cachekey,
+                        'lazy_restore': options['lazy_restore'],
+                        'lazy_hot': ' '.join([pipes.quote(x) for x in options['lazy_hot']])}
+            localmap.update(csub_vars_map)
+            epiloguetxt = EPILOGUE % localmap
             file(epilogue_script, 'w').write(epiloguetxt)
             os.chmod(epilogue_script, 0755)
         except Exception, err:
@@ -521,22 +1743,21 @@ def runall(scriptname, parent_dir, script, job_time, chkpt_time, prestage, posts
             sys.exit(1)
 
     user_chkpt_script = """#!/bin/bash
+""" + JOB_STATE + """
 echo "Checkpointing job at request of user (time: `date`)"
-# check for file containing PID of master
-if [ ! -f $CSUB_MASTER_PID_FILE ]
+# check for PID of master in job state
+pid=`state_get $CSUB_STATE_FILE pid`
+if [ -z "$pid" ]
 then
-   echo "ERROR! File containing job ID not available (\"$CSUB_MASTER_PID_FILE\")"
+   echo "ERROR! Job ID not available in job state (\"$CSUB_STATE_FILE\")"
    exit 12345
-else
-   pid=`cat $CSUB_MASTER_PID_FILE`
 fi
 
-# touch file to acknowledge checkpoint by user
-touch $CSUB_KILL_ACK_FILE
+# acknowledge checkpoint by user in job state
+state_set $CSUB_STATE_FILE user_kill=1
 if [ $? -ne 0 ]
 then
-    echo "ERROR! Failed to create acknowledgement file: $CSUB_KILL_ACK_FILE ."
-    rm -f $CSUB_KILL_ACK_FILE
+    echo "ERROR! Failed to record acknowledgement in job state: $CSUB_STATE_FILE ."
     exit 12345
 fi
 
@@ -551,9 +1772,9 @@ if [ $exit_code -eq 0 ]; then
     dmtcp_command --port $coord_port --status
     dmtcp_command --port $coord_port --quit
 else
-    echo "ERROR! Checkpointing master (pid: `cat $CSUB_MASTER_PID_FILE`) failed (exit code: $exit_code)."
+    echo "ERROR! Checkpointing master (pid: $pid) failed (exit code: $exit_code)."
     ls -l $CSUB_CHECKPOINT_FILE
-    rm -f $CSUB_KILL_ACK_FILE
+    state_set $CSUB_STATE_FILE user_kill=
     exit 12345
 fi
     """
@@ -577,7 +1798,7 @@ fi
     prologue_str = "echo #"
     epilogue_str = "echo #"
     if (not shared):
-        if mimic_pro_epi:
+        if options['mimic_pro_epi']:
             # mimic pro/epilogue scripts by calling them from base
             prologue_str = prologue_script
             epilogue_str = epilogue_script
@@ -589,12 +1810,29 @@ fi
     localmap = {'prologue': prologue_str,
                 'epilogue': epilogue_str,
                 'job_time': job_time,
-                'cleanup_after_restart': cleanup_after_restart,
-                'cleanup_chkpt': cleanup_chkpt,
+                'cleanup_after_restart': options['cleanup_after_restart'],
+                'cleanup_chkpt': options['cleanup_chkpt'],
                 'chkptsubdir': chkptsubdir,
-                'user_chkpt_script_file': user_chkpt_script_file
+                'user_chkpt_script_file': user_chkpt_script_file,
+                'adaptive_chkpt_time': options['adaptive_chkpt_time'],
+                'chkpt_mtbf': options['chkpt_mtbf'],
+                'chkpt_generations': options['chkpt_generations'],
+                'chkpt_signals': ' '.join(options['chkpt_signals']),
+                'auto_storage': options['auto_storage'],
+                'image_estimate': image_estimate,
+                'mpi': options['mpi'],
+                'prequeue': options['prequeue'],
+                'lazy_restore': options['lazy_restore'],
+                'profile_interval': options['profile'] or (options['auto_vmem'] and default_profile_interval),
+                'auto_vmem': options['auto_vmem'],
+                'vmem_margin': vmem_margin,
+                'job_state': JOB_STATE,
+                'copy_tree': COPY_TREE,
+                'wait_for_restore': WAIT_FOR_RESTORE,
+                'storage_space': STORAGE_SPACE,
                 }
     localmap.update(csub_vars_map)
+    localmap['CSUB_KILL_MODE'] = options['kill_mode']
     base_script = BASE % localmap
 
     # construct total wall time string
@@ -608,8 +1846,10 @@ fi
                                   'prologue_header_spec': prologue_header_spec,
                                   'name': scriptname,
                                   'chkptdirbase': chkptdirbase,
-                                  'queue': queue,
-                                  'vmem': vmem,
+                                  'queue': options['queue'],
+                                  'vmem': options['vmem'],
+                                  'chkpt_signals': options['chkpt_signals'],
+                                  'chkpt_signal_time': options['chkpt_signal_time'],
                                   }, script)
 
     try:
@@ -622,21 +1862,45 @@ fi
         # make chkpoint tarball
         # options must match pack/unpack from epilogue
         tb = os.path.join(chkptdir, tarbfilename)
-        cmd = "tar -c -p -C %s -f %s . && touch %s.ok" % (chkptdirbase, tb, tb)
+        compress_opt = ""
+        if tar_codecs[compress]:
+            compress_opt = "--use-compress-program='%s'" % tar_codecs[compress]
+        tbcodec = os.path.join(chkptdir, tarbcodecfilename)
+        tbsum = os.path.join(chkptdir, tarbsumfilename)
+        cmd = "tar -c -p %s -C %s -f - ." % (compress_opt, chkptdirbase)
         try:
-            p = popen2.Popen4(cmd)  # execute tar in sub-process, catch both stdout/stderr as stdout
+            # stream tarball to its destination and compute checksum on the fly, like tar_create in epilogue
+            p = popen2.Popen3(cmd, True)  # execute tar in sub-process, tarball on stdout
             p.tochild.close()  # no input to pass
+            md5 = hashlib.md5()
+            f = file(tb, 'wb')
+            while True:
+                data = p.fromchild.read(1024 * 1024)
+                if not data:
+                    break
+                md5.update(data)
+                f.write(data)
+            f.close()
+            out = p.childerr.read()  # read error output of tar command
             ec = p.wait()  # wait for process, catch return value
-            out = p.fromchild.read()  # read output of tar command
         except Exception, err:
             sys.stderr.write("Something went wrong with forking tar (%s): %s\n" % (cmd, err))
             sys.exit(1)
         if ec > 0:
             sys.stderr.write("Tar failed: exitcode %s, output %s, cmd %s\n" % (ec, out, cmd))
             sys.exit(1)
+        try:
+            file(tbcodec, 'w').write("%s\n" % compress)
+            file(tbsum, 'w').write("%s\n" % md5.hexdigest())
+        except IOError, err:
+            sys.stderr.write("Failed to write metadata of tarball %s: %s\n" % (tb, err))
+            sys.exit(1)
+        update_job_state(os.path.join(chkptdir, statefilename), tarball='ok')
 
     # submit 1 job
-    submitbase(base, scriptname)
+    jobid = submitbase(base, scriptname, options['arrayspec'])
+    index_state(scriptname, 'submitted', jobid)
+    return jobid
 
 
 # try to parse time string and compute in seconds
@@ -652,199 +1916,485 @@ def parsetime(time_str):
         return None
 
 
-if __name__ == '__main__':
+# try to parse size string (e.g. vmem, 4gb) and compute in bytes
+def parsesize(size_str):
+    regsize = re.compile("^(?P<size>\d+)(?P<unit>[kmgt]?)b?$", re.IGNORECASE).search(size_str.strip())
+    if regsize:
+        return int(regsize.group("size")) * 1024 ** "bkmgt".index((regsize.group("unit") or "b").lower())
+    else:
+        return None
+
+
+# parse command line options (list of arguments, e.g. sys.argv[1:])
+# returns dict with value for all options, and remaining arguments
+def parse_options(args):
     import getopt
 
-    allopts = ["help", "pre", "post", "shared", "job_time=", "chkpt_time=",
+    allopts = ["help", "auto_storage", "mpi", "pre", "pre_include=", "pre_exclude=", "pre_manifest=", "pre_workers=", "post", "post_results=",
+               "post_workers=", "post_pack_small=", "shared", "job_time=", "chkpt_time=",
                "cleanup_after_restart", "no_cleanup_chkpt", "resume=", "chkpt_save_opt=",
-               "term_kill_mode", "vmem="]
+               "term_kill_mode", "vmem=", "compress=", "incremental=", "dedup", "lazy_restore", "lazy_hot=", "adaptive_chkpt_time",
+               "chkpt_mtbf=", "chkpt_signal=", "chkpt_signal_time=", "prequeue", "profile=", "pack_verbosity=", "chkpt_generations=", "bulk=", "bulk_workers=", "status", "json", "report=",
+               "gc", "gc_age=", "gc_states=", "gc_dry_run"]
     try:
-        opts, args = getopt.getopt(sys.argv[1:], "hs:q:t:", allopts)
+        opts, args = getopt.getopt(args, "hs:q:t:", allopts)
     except getopt.GetoptError, err:
         print "\n" + str(err)
         usage()
         sys.exit(2)
 
-    script = None
-    prestage = None
-    poststage = None
-    shared = False
-    queue = None
-    # variable to control hack which mimics prologue/epilogue functionality
-    # this should be removed when the prologue/epilogue problems caused by root squash are fixed in Torgue
-    mimic_pro_epi = True
-    job_time_spec = False
-    job_time = 10 * 60 * 60  # default: 10 hours
-    chkpt_time_spec = False
-    chkpt_time = 15 * 60  # default: 15 minutes
-    arrayspec = None
-    cleanup_after_restart = False
-    cleanup_chkpt = True
-    resume_job_name = None
-    vmem = None
+    options = {
+        'script': None,
+        'script_filename': None,
+        'prestage': None,
+        'pre_include': [],
+        'pre_exclude': [],
+        'pre_manifest': None,
+        'pre_workers': 4,
+        'poststage': None,
+        'post_results': [],
+        'post_workers': 4,
+        'post_pack_small': 0,
+        'shared': False,
+        'auto_storage': False,
+        'mpi': False,
+        'queue': None,
+        # variable to control hack which mimics prologue/epilogue functionality
+        # this should be removed when the prologue/epilogue problems caused by root squash are fixed in Torgue
+        'mimic_pro_epi': True,
+        'job_time_spec': False,
+        'job_time': 10 * 60 * 60,  # default: 10 hours
+        'chkpt_time_spec': False,
+        'chkpt_time': 15 * 60,  # default: 15 minutes
+        'arrayspec': None,
+        'cleanup_after_restart': False,
+        'cleanup_chkpt': True,
+        'resume_job_name': None,
+        'kill_mode': csub_vars_map['CSUB_KILL_MODE'],
+        'vmem': None,
+        'auto_vmem': False,
+        'profile': 0,  # default: no sampling of resource usage
+        'compress': 'none',
+        'pack_verbosity': 1,
+        'incremental': 0,
+        'dedup': False,
+        'lazy_restore': False,
+        'lazy_hot': [],
+        'adaptive_chkpt_time': False,
+        'chkpt_mtbf': 0,  # default: no periodic checkpoints
+        'chkpt_generations': 2,
+        'chkpt_signals': [],
+        'chkpt_signal_time': 0,
+        'prequeue': False,
+        'bulk': None,
+        'bulk_workers': 8,
+        'status': False,
+        'json': False,
+        'report': None,
+        'gc': False,
+        'gc_age': 7 * 24 * 60 * 60,  # default: 1 week
+        'gc_states': ['complete', 'killed', 'failed'],
+        'gc_dry_run': False,
+    }
 
     # read command line options specified
     for key, value in opts:
         if key in ["-h", "--help"]:
             usage()
         if key in ["-s"]:
-            script_filename = value
+            options['script_filename'] = value
             try:
-                script = open(script_filename).read()
+                options['script'] = open(value).read()
             except Exception, err:
-                sys.stderr.write("Can't read jobscript %s:%s\n" % (script_filename, err))
+                sys.stderr.write("Can't read jobscript %s:%s\n" % (value, err))
                 sys.exit(1)
         if key in ["-q"]:
-            queue = value
+            options['queue'] = value
         if key in ["-t"]:
-            arrayspec = value
+            options['arrayspec'] = value
         if key in ["--job_time"]:
-            job_time_str = value
-            job_time = parsetime(job_time_str)
-            if not job_time:
-                sys.stderr.write("Failed to parse specified job time (%s).\n" % job_time_str)
+            options['job_time'] = parsetime(value)
+            if not options['job_time']:
+                sys.stderr.write("Failed to parse specified job time (%s).\n" % value)
                 sys.stderr.write("Please specify job time using <hours>:<minutes>:<seconds>, e.g. '3:12:47'\n")
                 sys.exit(1)
-            job_time_spec = True
+            options['job_time_spec'] = True
         if key in ["--chkpt_time"]:
-            chkpt_time_str = value
-            chkpt_time = parsetime(chkpt_time_str)
-            if not chkpt_time:
-                sys.stderr.write("Failed to parse specified job time (%s).\n" % chkpt_time_str)
+            options['chkpt_time'] = parsetime(value)
+            if not options['chkpt_time']:
+                sys.stderr.write("Failed to parse specified job time (%s).\n" % value)
                 sys.stderr.write("Please specify checkpoint time using <hours>:<minutes>:<seconds>, e.g. '3:12:47'\n")
                 sys.exit(1)
-            chkpt_time_spec = True
+            options['chkpt_time_spec'] = True
         if key in ['--pre']:
-            prestage = 'local'
+            options['prestage'] = 'local'
+        if key in ['--pre_include']:
+            options['prestage'] = 'local'
+            options['pre_include'].extend([x for x in value.split(',') if x])
+        if key in ['--pre_exclude']:
+            options['prestage'] = 'local'
+            options['pre_exclude'].extend([x for x in value.split(',') if x])
+        if key in ['--pre_manifest']:
+            options['prestage'] = 'local'
+            options['pre_manifest'] = os.path.abspath(value)
+            if not os.path.isfile(options['pre_manifest']):
+                sys.stderr.write("Prestage manifest %s not found.\n" % value)
+                sys.exit(1)
+        if key in ['--pre_workers']:
+            try:
+                options['pre_workers'] = int(value)
+            except ValueError:
+                options['pre_workers'] = 0
+            if options['pre_workers'] < 1:
+                sys.stderr.write("Number of prestage workers should be a positive integer (%s).\n" % value)
+                sys.exit(1)
         if key in ['--post']:
-            poststage = 'local'
+            options['poststage'] = 'local'
+        if key in ['--post_results']:
+            options['poststage'] = 'local'
+            options['post_results'].extend([x for x in value.split(',') if x])
+        if key in ['--post_workers']:
+            try:
+                options['post_workers'] = int(value)
+            except ValueError:
+                options['post_workers'] = 0
+            if options['post_workers'] < 1:
+                sys.stderr.write("Number of poststage workers should be a positive integer (%s).\n" % value)
+                sys.exit(1)
+        if key in ['--post_pack_small']:
+            options['poststage'] = 'local'
+            try:
+                options['post_pack_small'] = int(value)
+            except ValueError:
+                options['post_pack_small'] = -1
+            if options['post_pack_small'] < 0:
+                sys.stderr.write("Size of small files to pack in poststage should be a positive integer (%s).\n" % value)
+                sys.exit(1)
+        if key in ['--auto_storage']:
+            options['auto_storage'] = True
         if key in ['--shared']:
-            shared = True
+            options['shared'] = True
+        if key in ['--mpi']:
+            # all nodes need access to the job directory
+            options['mpi'] = True
+            options['shared'] = True
         if key in ['--no_mimic_pro_epi']:
-            mimic_pro_epi = False
+            options['mimic_pro_epi'] = False
         if key in ['--cleanup_after_restart']:
-            cleanup_after_restart = True
+            options['cleanup_after_restart'] = True
         if key in ['--no_cleanup_chkpt']:
-            cleanup_chkpt = False
+            options['cleanup_chkpt'] = False
         if key in ['--resume']:
-            resume_job_name = value
+            options['resume_job_name'] = value
         if key in ['--term_kill_mode']:
-            csub_vars_map.update({'CSUB_KILL_MODE': 'term'})
+            options['kill_mode'] = 'term'
         if key in ['--vmem']:
-            vmem = value
+            if value == 'auto':
+                options['auto_vmem'] = True
+            else:
+                options['vmem'] = value
+        if key in ['--compress']:
+            options['compress'] = value
+            if value not in tar_codecs:
+                sys.stderr.write("Unknown compression codec %s, use one of: %s\n" % (value, ', '.join(sorted(tar_codecs.keys()))))
+                sys.exit(1)
+        if key in ['--pack_verbosity']:
+            try:
+                options['pack_verbosity'] = int(value)
+            except ValueError:
+                options['pack_verbosity'] = -1
+            if options['pack_verbosity'] not in [0, 1, 2]:
+                sys.stderr.write("Pack verbosity should be 0, 1 or 2 (%s).\n" % value)
+                sys.exit(1)
+        if key in ['--incremental']:
+            try:
+                options['incremental'] = int(value)
+            except ValueError:
+                options['incremental'] = -1
+            if options['incremental'] < 0:
+                sys.stderr.write("Failed to parse specified number of incremental layers (%s).\n" % value)
+                sys.exit(1)
+        if key in ['--lazy_restore']:
+            options['lazy_restore'] = True
+        if key in ['--lazy_hot']:
+            options['lazy_restore'] = True
+            options['lazy_hot'].extend([x for x in value.split(',') if x])
+        if key in ['--adaptive_chkpt_time']:
+            options['adaptive_chkpt_time'] = True
+        if key in ['--chkpt_mtbf']:
+            options['chkpt_mtbf'] = parsetime(value)
+            if not options['chkpt_mtbf']:
+                sys.stderr.write("Failed to parse specified mean time between failures (%s).\n" % value)
+                sys.stderr.write("Please specify it using <hours>:<minutes>:<seconds>, e.g. '72:0:0'\n")
+                sys.exit(1)
+        if key in ['--chkpt_signal']:
+            import signal
+            for sig in [x.upper() for x in value.split(',') if x]:
+                if sig.startswith('SIG'):
+                    sig = sig[3:]
+                # USR1 is used internally by base, KILL and STOP can't be trapped
+                if not hasattr(signal, 'SIG%s' % sig) or sig in ['USR1', 'KILL', 'STOP', 'CHLD']:
+                    sys.stderr.write("Unsupported checkpoint signal (%s).\n" % sig)
+                    sys.exit(1)
+                if sig not in options['chkpt_signals']:
+                    options['chkpt_signals'].append(sig)
+        if key in ['--chkpt_signal_time']:
+            options['chkpt_signal_time'] = parsetime(value)
+            if not options['chkpt_signal_time']:
+                sys.stderr.write("Failed to parse specified checkpoint signal time (%s).\n" % value)
+                sys.stderr.write("Please specify it using <hours>:<minutes>:<seconds>, e.g. '0:10:0'\n")
+                sys.exit(1)
+        if key in ['--prequeue']:
+            options['prequeue'] = True
+        if key in ['--profile']:
+            options['profile'] = parsetime(value)
+            if not options['profile']:
+                sys.stderr.write("Failed to parse specified sampling interval (%s).\n" % value)
+                sys.stderr.write("Please specify it using <hours>:<minutes>:<seconds>, e.g. '0:1:0'\n")
+                sys.exit(1)
+        if key in ['--chkpt_generations']:
+            try:
+                options['chkpt_generations'] = int(value)
+            except ValueError:
+                options['chkpt_generations'] = 0
+            if options['chkpt_generations'] < 1:
+                sys.stderr.write("Number of checkpoint generations should be a positive integer (%s).\n" % value)
+                sys.exit(1)
+        if key in ['--dedup']:
+            options['dedup'] = True
+        if key in ['--bulk']:
+            options['bulk'] = value
+        if key in ['--bulk_workers']:
+            try:
+                options['bulk_workers'] = int(value)
+            except ValueError:
+                options['bulk_workers'] = 0
+            if options['bulk_workers'] < 1:
+                sys.stderr.write("Number of bulk workers should be a positive integer (%s).\n" % value)
+                sys.exit(1)
+        if key in ['--status']:
+            options['status'] = True
+        if key in ['--json']:
+            options['json'] = True
+        if key in ['--report']:
+            options['report'] = value
+        if key in ['--gc']:
+            options['gc'] = True
+        if key in ['--gc_age']:
+            options['gc_age'] = parsetime(value)
+            if not options['gc_age']:
+                sys.stderr.write("Failed to parse specified age (%s).\n" % value)
+                sys.stderr.write("Please specify it using <hours>:<minutes>:<seconds>, e.g. '168:0:0'\n")
+                sys.exit(1)
+        if key in ['--gc_states']:
+            options['gc_states'] = [x for x in value.split(',') if x]
+        if key in ['--gc_dry_run']:
+            options['gc_dry_run'] = True
         if key in ['--chkpt_save_opt']:
             sys.stderr.write("Use of --chkpt_save_opt is no longer supported\n")
             sys.exit(1)
 
-    if not script and not resume_job_name:
-        print """ERROR! No jobscript read or job to resume specified.
-Please use -s or --script to specify the job script, or
-use --resume=>job_name> to resume a job from the latest checkpoint.
-(use -h or --help for help)"""
+    if options['incremental'] and options['dedup']:
+        sys.stderr.write("--incremental and --dedup can not be combined.\n")
         sys.exit(1)
 
-    if resume_job_name:
+    if options['lazy_restore'] and (options['incremental'] or options['dedup']):
+        sys.stderr.write("--lazy_restore can not be combined with --incremental or --dedup.\n")
+        sys.exit(1)
 
-        if script or queue or arrayspec or prestage or poststage:
-            txt = """ERROR! Found extra options when resuming from checkpoint! (see -h or --help)
-This is useless, because the original job script is part of the checkpoint, and this script will be resubmitted.
-If you want to vary job parameters, please see --vmem, --job_time and/or --chkpt_time."""
-            print txt
+    # background extraction must outlive the prologue, so it must be run by base
+    if options['lazy_restore'] and not options['mimic_pro_epi']:
+        sys.stderr.write("--lazy_restore and --no_mimic_pro_epi can not be combined.\n")
+        sys.exit(1)
+
+    if options['auto_storage'] and options['mpi']:
+        sys.stderr.write("--auto_storage and --mpi can not be combined.\n")
+        sys.exit(1)
+
+    if options['auto_storage'] and options['shared']:
+        sys.stderr.write("--auto_storage and --shared can not be combined.\n")
+        sys.exit(1)
+
+    # a periodic checkpoint only covers the process state: with a node-local job dir, the files it refers to are only
+    # saved (in the tarball) at the end of the job, so restarting from a newer periodic checkpoint would not match them
+    if options['chkpt_mtbf'] and not options['shared']:
+        sys.stderr.write("--chkpt_mtbf requires --shared (or --mpi).\n")
+        sys.exit(1)
+
+    if options['chkpt_signal_time'] and not options['chkpt_signals']:
+        sys.stderr.write("--chkpt_signal_time requires --chkpt_signal.\n")
+        sys.exit(1)
+
+    return (options, args)
+
+
+# start new job for job script (with options as returned by parse_options)
+# returns output of submission (job id)
+def submitjob(options, unique_script_name=None):
+
+    script_filename = options['script_filename']
+    script = options['script']
+
+    # generate unique script name
+    if not unique_script_name:
+        unique_script_name = uniquescriptname(script_filename, script)
+
+    # check if shebang is present
+    shebang = re.match("^#!", script)
+    if not shebang:
+        sys.stderr.write("The job script %s must start with a shebang (#!).\n" % script_filename)
+        sys.exit(1)
+
+    # parent directory of script (for copying local results in prestage/poststage)
+    parent_dir = os.path.dirname(os.path.abspath(script_filename))
+
+    return runall(unique_script_name, parent_dir, script, options)
+
+
+# read bulk manifest: one job per line, job script followed by (per-job) csub options
+# identical jobs (same script and options) are combined into a single array job
+# returns list of (options, number of identical jobs)
+def read_bulk_manifest(manifest):
+    import shlex
+
+    try:
+        lines = open(manifest).readlines()
+    except IOError, err:
+        sys.stderr.write("Can't read bulk manifest %s: %s\n" % (manifest, err))
+        sys.exit(1)
+
+    jobs = []
+    index = {}
+    for line in lines:
+        if not line.strip() or line.strip().startswith('#'):
+            continue
+        fields = shlex.split(line)
+        (options, args) = parse_options(['-s'] + fields)
+        if args or options['resume_job_name'] or options['bulk']:
+            sys.stderr.write("Unsupported options in bulk manifest line: %s\n" % line.strip())
             sys.exit(1)
 
-        # try and resume job with specified name
-        (base, arrayid) = checkResume(resume_job_name)
+        key = (os.path.abspath(options['script_filename']), tuple(fields[1:]))
+        if key in index and not options['arrayspec']:
+            jobs[index[key]][1] += 1
+        else:
+            if not options['arrayspec']:
+                index[key] = len(jobs)
+            jobs.append([options, 1])
 
-        if base:
-            # make sure it also works correctly for array jobs
-            if arrayid:
-                arrayspec = arrayid
+    return jobs
 
-            try:
-                f = open(base, "r")
-                basetxt = f.read()
-                f.close()
-            except IOError as err:
-                sys.stderr.write("Failed to read base script %s: %s\n" % (base, err))
-                sys.exit(1)
 
-            # change job time and/or chkpt_time before resubmitting
-            if job_time_spec or chkpt_time_spec or vmem:
-                walltime_script = get_wall_time(basetxt)
+# submit all jobs in bulk manifest in parallel, using a pool of worker threads
+# prints per-job results as JSON
+def submitbulk(manifest, workers):
+    import json
+    import random
+    import time
+
+    jobs = read_bulk_manifest(manifest)
+
+    # generate unique names up front, to avoid name clashes between jobs submitted in the same second
+    names = set()
+    for job in jobs:
+        options = job[0]
+        tries = 0
+        name = uniquescriptname(options['script_filename'], options['script'])
+        while name in names or os.path.exists(os.path.join(chkptdirbasebase, name)):
+            tries += 1
+            if tries % 100 == 0:
+                time.sleep(1)
+            name = uniquescriptname(options['script_filename'], options['script'])
+        names.add(name)
+        job.append(name)
+
+        # combine identical jobs into a single array job
+        if job[1] > 1:
+            options['arrayspec'] = "1-%d" % job[1]
+
+    def submit(job):
+        (options, count, name) = job
+        result = {
+            'script': options['script_filename'],
+            'name': name,
+            'jobs': count,
+            'array': options['arrayspec'],
+        }
+        try:
+            result['jobid'] = submitjob(options, unique_script_name=name)
+            result['status'] = 'submitted'
+        except SystemExit, err:
+            result['status'] = 'failed'
+            result['exitcode'] = err.code
+        except Exception, err:
+            result['status'] = 'failed'
+            result['error'] = str(err)
+        return result
 
-                job_time_regexp = re.compile(
-                    "^(chksltot)=(?P<job_time>[0-9]+)\s*(\S*)$", re.MULTILINE)
-                job_time_script = int(
-                    job_time_regexp.search(basetxt).group('job_time'))
+    results = run_parallel(submit, jobs, workers)
 
-                if job_time_spec:
-                    new_job_time = job_time
-                else:
-                    new_job_time = job_time_script
+    print json.dumps(results, indent=4)
 
-                if chkpt_time_spec:
-                    new_chkpt_time = chkpt_time
-                else:
-                    new_chkpt_time = walltime_script - job_time_script
+    if [x for x in results if x['status'] != 'submitted']:
+        sys.exit(1)
 
-                wall_time_str = gen_wall_time_str(
-                    new_job_time + new_chkpt_time)
 
-                basetxt = job_time_regexp.sub(
-                    r"\1=%d \3\n" % new_job_time, basetxt)
-                basetxt = replace_walltime_str(basetxt, wall_time_str)
+if __name__ == '__main__':
 
-                if vmem:
-                    basetxt = replace_vmem(basetxt, vmem)
+    (options, args) = parse_options(sys.argv[1:])
+    resume_job_name = options['resume_job_name']
 
-                try:
-                    f = open(base, "w")
-                    f.write(basetxt)
-                    f.close()
-                except Exception, err:
-                    sys.stderr.write("Failed to backup/rewrite base script %s when adjusting job_time/chkpt_time: %s\n" % (base, err))
-                    sys.exit(1)
+    if options['status']:
+        show_status(options['json'])
+        sys.exit(0)
 
-            outputfiles = re.compile("^\s*#PBS\s+-o\s+(?P<chkptdirbase>\S+)/(?P<name>[^/]+).base.out\s*$", re.MULTILINE).search(basetxt).groupdict()
-            tomove = []
+    if options['report']:
+        show_report(options['report'], options['json'])
+        sys.exit(0)
 
-            if arrayid:
-                outputfiles["arrayid"] = arrayid
-                tomove.append("%(chkptdirbase)s-%(arrayid)s/%(name)s-%(arrayid)s.out" % outputfiles)
-                tomove.append("%(chkptdirbase)s-%(arrayid)s/%(name)s-%(arrayid)s.err" % outputfiles)
-                tomove.append("%(chkptdirbase)s/%(name)s.base.out-%(arrayid)s" % outputfiles)
-                tomove.append("%(chkptdirbase)s/%(name)s.base.err-%(arrayid)s" % outputfiles)
-            else:
-                tomove.append("%(chkptdirbase)s/%(name)s.out" % outputfiles)
-                tomove.append("%(chkptdirbase)s/%(name)s.err" % outputfiles)
-                tomove.append("%(chkptdirbase)s/%(name)s.base.out" % outputfiles)
-                tomove.append("%(chkptdirbase)s/%(name)s.base.err" % outputfiles)
+    if options['gc']:
+        collect_garbage(options)
+        sys.exit(0)
 
-            for filename in tomove:
-                try:
-                    print "Taking backup of output file %s" % filename
-                    shutil.copy2(filename, "%s.prev" % filename)
-                except OSError as err:
-                    sys.stderr.write("Failed to rename the log output of the previous run: %s\n" % filename)
-                    sys.exit(1)
+    if options['bulk']:
+        if options['script'] or resume_job_name:
+            sys.stderr.write("--bulk can not be combined with -s or --resume, specify job options in the manifest.\n")
+            sys.exit(1)
+        submitbulk(options['bulk'], options['bulk_workers'])
+        sys.exit(0)
+
+    if not options['script'] and not resume_job_name:
+        print """ERROR! No jobscript read or job to resume specified.
+Please use -s or --script to specify the job script, or
+use --resume=>job_name> to resume a job from the latest checkpoint.
+(use -h or --help for help)"""
+        sys.exit(1)
+
+    if resume_job_name:
+
+        if options['script'] or options['queue'] or options['arrayspec'] or options['prestage'] or options['poststage'] \
+                or options['compress'] != 'none' or options['incremental'] or options['dedup'] \
+                or options['pack_verbosity'] != 1 or options['chkpt_signals'] or options['auto_storage'] \
+                or options['mpi'] or options['prequeue'] or options['profile'] or options['lazy_restore']:
+            txt = """ERROR! Found extra options when resuming from checkpoint! (see -h or --help)
+This is useless, because the original job script is part of the checkpoint, and this script will be resubmitted.
+If you want to vary job parameters, please see --vmem, --job_time and/or --chkpt_time."""
+            print txt
+            sys.exit(1)
+
+        if ',' in resume_job_name or re.search(r'[*?\[]', resume_job_name):
+            # batch of jobs (list of names and/or glob patterns)
+            resume_jobs(expand_resume_names(resume_job_name), options)
+            sys.exit(0)
 
-            submitbase(base, resume_job_name)
+        (base, arrayspec) = prepare_resume(resume_job_name, options)
+        if base:
+            jobid = submitbase(base, resume_job_name, arrayspec)
+            index_state(resume_job_name, 'resumed', jobid)
             print "Job %s succesfully resumed." % resume_job_name
         else:
             sys.stderr.write("Resuming of job %s failed. Sorry.\n" % resume_job_name)
             sys.exit(1)
     else:
         # start new job
-        # generate unique script name
-        unique_script_name = uniquescriptname(script_filename, script)
-
-        # check if shebang is present
-        shebang = re.match("^#!", script)
-        if not shebang:
-            sys.stderr.write("The job script %s must start with a shebang (#!).\n" % script_filename)
-            sys.exit(1)
-
-        # parent directory of script (for copying local results in prestage/poststage)
-        parent_dir = os.path.dirname(os.path.abspath(script_filename))
-
-        runall(unique_script_name, parent_dir, script, job_time, chkpt_time, prestage, poststage, shared, queue, mimic_pro_epi, cleanup_after_restart, vmem)
+        submitjob(options)
@@ -71,9 +71,17 @@ endd () {
     exit 0
 }
 
+# full listing of current directory, only with highest verbosity
+listing () {
+    if [ $verbosity -ge 2 ]
+    then
+        ls -lrt
+    fi
+}
+
 cleanuplocal () {
     ## cleanup localdir
-    ls -l
+    listing
     cd $CURRENTDIR
     rm -Rf $localdir
     if [ $? -gt 0 ]
@@ -83,19 +91,501 @@ cleanuplocal () {
 
 }
 
+# map compression codec name to (multi-threaded) compression program
+# tar passes -d to the program for decompression
+codec_prog () {
+    case $1 in
+        gzip)
+            echo "gzip"
+            ;;
+        pigz)
+            echo "pigz"
+            ;;
+        zstd)
+            echo "zstd -T0"
+            ;;
+        *)
+            echo ""
+            ;;
+    esac
+}
+
+# create archive $1 from the files in the current directory
+# remaining arguments are passed to tar (default: .)
+# codec used is recorded in $1.codec
+# checksum is computed while the archive streams to its destination (it is never read back), and recorded in $1.md5
+tar_create () {
+    archive=$1
+    shift
+    codec=$tarcodec
+    if [ "$codec" != "none" ] && ! which $codec > /dev/null 2>&1
+    then
+        myecho "Compression codec $codec not available, packing without compression."
+        codec=none
+    fi
+    compprog=`codec_prog $codec`
+    rm -f "$archive.codec" "$archive.md5"
+    ## tar messages (and listing) go to stdout, archive itself goes through the pipe
+    (
+        set -o pipefail
+        time tar -c $taropts ${compprog:+--use-compress-program="$compprog"} -f - "${@:-.}" 2>&3 \
+            | tee "$archive" | md5sum | cut -c1-32 > "$archive.md5.new"
+    ) 3>&1
+    ec=$?
+    ## record codec next to tarball, so prologue picks matching decompressor
+    echo $codec > "$archive.codec"
+    if [ $ec -gt 0 ]
+    then
+        rm -f "$archive.md5.new"
+        return $ec
+    fi
+    mv "$archive.md5.new" "$archive.md5"
+    if [ $verbosity -ge 1 ]
+    then
+        myecho "Packed $archive: `stat -c %%s "$archive"` bytes, md5 `cat "$archive.md5"`"
+    fi
+}
+
+# extract archive $1 in the current directory, using codec recorded in $1.codec
+# checksum recorded in $1.md5 (if any) is verified while the archive streams through tar
+tar_extract () {
+    archive=$1
+    codec=none
+    if [ -f "$archive.codec" ]
+    then
+        codec=`cat "$archive.codec"`
+    fi
+    if [ $verbosity -ge 1 ]
+    then
+        myecho "Tarball $archive compression codec: $codec"
+    fi
+    compprog=`codec_prog $codec`
+    sumfifo=`mktemp -u`
+    mkfifo "$sumfifo" || return 1
+    md5sum < "$sumfifo" | cut -c1-32 > "$sumfifo.sum" &
+    sumpid=$!
+    (
+        set -o pipefail
+        time tee "$sumfifo" < "$archive" | tar -x $taropts ${compprog:+--use-compress-program="$compprog"} -f - 2>&1
+    )
+    ec=$?
+    wait $sumpid
+    sum=`cat "$sumfifo.sum"`
+    rm -f "$sumfifo" "$sumfifo.sum"
+    if [ $ec -gt 0 ]
+    then
+        return $ec
+    fi
+    if [ -f "$archive.md5" ] && [ "$sum" != "`cat "$archive.md5"`" ]
+    then
+        myecho "Checksum of $archive ($sum) does not match recorded checksum (`cat "$archive.md5"`)"
+        return 1
+    fi
+}
+
+# compute manifest of current directory: <size> <mtime> <md5sum> <path>
+# size/mtime are compared with previous manifest $1, md5sum is only recomputed for files that differ
+# paths of files with changed content are written to $2, paths of removed files to $3
+make_manifest () {
+    prevmanifest=$1
+    changed=$2
+    deleted=$3
+    tmpd=`mktemp -d`
+    find . -type f -printf '%%s %%T@ %%p\n' | awk -v prev="$prevmanifest" -v todo="$tmpd/todo" -v deleted="$deleted" '
+        BEGIN {
+            while ((getline line < prev) > 0) {
+                split(line, f, " ")
+                p = line
+                sub(/^[^ ]+ [^ ]+ [^ ]+ /, "", p)
+                meta[p] = f[1] " " f[2]
+                sum[p] = f[3]
+            }
+        }
+        {
+            p = $0
+            sub(/^[^ ]+ [^ ]+ /, "", p)
+            # tar only preserves mtime up to the second
+            m = $1 " " int($2)
+            seen[p] = 1
+            if (p in meta && meta[p] == m) {
+                print m " " sum[p] " " p
+            } else {
+                print m " " (p in sum ? sum[p] : "-") " " p > todo
+            }
+        }
+        END {
+            for (p in meta) {
+                if (!(p in seen)) {
+                    print p > deleted
+                }
+            }
+        }' > "$tmpd/manifest"
+    touch "$tmpd/todo" "$deleted"
+    while read -r size mtime oldsum path
+    do
+        newsum=`md5sum < "$path" | cut -d' ' -f1`
+        if [ "$newsum" != "$oldsum" ]
+        then
+            echo "$path" >> "$changed"
+        fi
+        echo "$size $mtime $newsum $path" >> "$tmpd/manifest"
+    done < "$tmpd/todo"
+    cp "$tmpd/manifest" "$tarb.manifest.new"
+    rm -Rf "$tmpd"
+}
+
+# read chunk $2 (counting from 0, $storechunk bytes each) of file $1
+store_chunk () {
+    dd if="$1" bs=$storechunk skip=$2 count=1 status=none
+}
+
+# put chunk $2 of file $1 in content-addressed store (if not there yet) and reference it from ref dir $3
+# the chunk is read straight from the file (twice if it is new), it is never staged elsewhere
+# reference counting is done through hard links: object with link count 1 is no longer referenced
+store_put () {
+    path=$1
+    ref=$3
+    sum=`store_chunk "$path" $2 | md5sum | cut -c1-32`
+    obj="$storedir/objects/${sum:0:2}/$sum"
+    if ! ln -f "$obj" "$ref/$sum" 2> /dev/null
+    then
+        mkdir -p "$storedir/objects/${sum:0:2}"
+        store_chunk "$path" $2 > "$obj.$$" && mv "$obj.$$" "$obj" && ln -f "$obj" "$ref/$sum"
+        if [ $? -gt 0 ]
+        then
+            return 1
+        fi
+        ## keep track of bytes written to store
+        stat -c %%s "$obj" >> "$storebytes"
+    fi
+    echo $sum
+}
+
+# drop all references in ref dir $1, and remove objects that are no longer referenced
+store_release () {
+    ref=$1
+    if [ ! -d "$ref" ]
+    then
+        return 0
+    fi
+    for sum in `ls "$ref"`
+    do
+        obj="$storedir/objects/${sum:0:2}/$sum"
+        rm -f "$ref/$sum"
+        if [ "`stat -c %%h "$obj" 2> /dev/null`" == "1" ]
+        then
+            rm -f "$obj"
+        fi
+    done
+    rmdir "$ref"
+}
+
+# pack current directory into content-addressed store
+# regular files are split in chunks, recipe ($tarb.recipe) lists <mode> <mtime> <chunks> <path>
+# directories and symlinks go in (small) tarball $tarb
+store_pack () {
+    ref="$storedir/refs/$jobname"
+    newref="$ref.new"
+    rm -Rf "$newref"
+    mkdir -p "$newref" || return 1
+    storebytes="$tarb.recipe.bytes"
+    rm -f "$tarb.recipe.new" "$storebytes"
+    touch "$storebytes"
+    find . -type f -printf '%%m %%T@ %%s %%p\n' | while read -r mode mtime size path
+    do
+        chunks=""
+        for ((i = 0; i * $storechunk < $size; i++))
+        do
+            sum=`store_put "$path" $i "$newref"` || exit 1
+            chunks="${chunks:+$chunks,}$sum"
+        done
+        echo "$mode ${mtime/.*/} ${chunks:--} $path" >> "$tarb.recipe.new"
+    done
+    ec=$?
+    if [ $ec -gt 0 ]
+    then
+        rm -f "$storebytes"
+        store_release "$newref"
+        return $ec
+    fi
+    myecho "Packed `wc -l < $tarb.recipe.new` files in `ls $newref | wc -l` chunks in store $storedir"
+
+    find . -mindepth 1 \( -type d -o -type l \) > "$tarb.recipe.dirs"
+    tar_create "$tarb" --no-recursion -T "$tarb.recipe.dirs"
+    ec=$?
+    rm -f "$tarb.recipe.dirs"
+    if [ $ec -gt 0 ]
+    then
+        rm -f "$storebytes"
+        store_release "$newref"
+        return $ec
+    fi
+
+    pack_bytes=`awk '{ s += $1 } END { print s + 0 }' "$storebytes"`
+    rm -f "$storebytes"
+    pack_bytes=$(($pack_bytes + `stat -c %%s "$tarb"`))
+
+    ## switch to new references, release objects only used by previous pack
+    mv "$tarb.recipe.new" "$tarb.recipe"
+    rm -Rf "$ref.old"
+    if [ -d "$ref" ]
+    then
+        mv "$ref" "$ref.old"
+    fi
+    mv "$newref" "$ref"
+    store_release "$ref.old"
+}
+
+# restore files listed in $tarb.recipe from content-addressed store
+store_unpack () {
+    ref="$storedir/refs/$jobname"
+    while read -r mode mtime chunks path
+    do
+        mkdir -p "`dirname "$path"`"
+        : > "$path"
+        if [ "$chunks" != "-" ]
+        then
+            for sum in ${chunks//,/ }
+            do
+                cat "$ref/$sum" >> "$path" || return 1
+            done
+        fi
+        chmod $mode "$path"
+        touch -d @$mtime "$path"
+    done < "$tarb.recipe"
+}
+
+%(copy_tree)s
+# unpack initial tarball of array job: extracted once per node in a cache shared by all array tasks,
+# task directory is a (cheap) copy of the cache
+unpack_initial () {
+    fun=unpack_initial
+    myecho
+    myecho "begin $fun `date`"
+    unpack_start=`date +%%s`
+    mkdir -p "`dirname $initcache`"
+    (
+        flock 9
+        if [ ! -f "$initcache/.complete" ]
+        then
+            rm -Rf "$initcache"
+            mkdir -p "$initcache"
+            cd "$initcache" && tar_extract "$tarb" && touch "$initcache/.complete"
+        fi
+        if [ -f "$initcache/.complete" ]
+        then
+            copy_tree "$initcache" "$localdir" && rm -f "$localdir/.complete"
+        else
+            false
+        fi
+    ) 9> "$initcache.lock"
+    if [ $? -gt 0 ]
+    then
+        myecho "Unpacking initial tarball $tarb failed."
+        cleanuplocal
+        endd
+    fi
+    metrics_event unpack $unpack_start `stat -c %%s "$tarb"`
+    myecho "end $fun `date`"
+    myecho
+}
+
+# remove cache of initial tarball once no array tasks of this job are left on this node
+cleanup_initial_cache () {
+    base=`basename $chkptdir_initial`
+    if [ -d "$initcache" ]
+    then
+        (
+            flock 9
+            ls "$%(CSUB_SCRATCH_NODE)s" | grep "^${base}-[0-9]\+$" >& /dev/null
+            if [ $? -ne 0 ]
+            then
+                rm -Rf "$initcache"
+            fi
+        ) 9> "$initcache.lock"
+    fi
+}
+
+# remove node-local cache of prestaged files once no job that prestaged from it is left on this node
+cleanup_prestage_cache () {
+    if [ -n "$prestagecachekey" ] && [ -d "$prestagecache" ]
+    then
+        (
+            flock 9
+            rm -f "$prestagecache.jobs/$jobname"
+            for job in `ls "$prestagecache.jobs" 2> /dev/null`
+            do
+                if [ ! -d "$%(CSUB_SCRATCH_NODE)s/$job" ]
+                then
+                    rm -f "$prestagecache.jobs/$job"
+                fi
+            done
+            if [ -z "`ls "$prestagecache.jobs" 2> /dev/null`" ]
+            then
+                rm -Rf "$prestagecache" "$prestagecache.jobs"
+            fi
+        ) 9> "$prestagecache.lock"
+    fi
+}
+
+# choose job dir on first start: node-local if work dir and checkpoint images fit in the free space
+# on the node (with a margin of $storage_margin %%), shared ($chkptdir, like --shared) otherwise
+# this choice is final: DMTCP restarts processes in the same working directory
+choose_storage () {
+    storage=local
+    if ! fits_in $(($workdir_bytes + $image_estimate)) "$%(CSUB_SCRATCH_NODE)s"
+    then
+        storage=shared
+        shared_workdir=1
+    fi
+    myecho "Job dir on $storage storage (about $need bytes needed, $free bytes free on node)"
+    mkdir -p "$chkptdir"
+    echo $storage > "$storagefile"
+}
+
+# check whether path $1 matches any of the remaining arguments (patterns), see POSTSTAGELOCAL in csub
+matches () {
+    path=$1
+    shift
+    for pattern in "$@"
+    do
+        if [[ $pattern == */* ]]
+        then
+            [[ $path == $pattern ]] && return 0
+        else
+            [[ ${path##*/} == $pattern ]] && return 0
+        fi
+    done
+    return 1
+}
+
+# files needed right after a restart (with --lazy_restore), one per line relative to the job dir:
+# hot set recorded by base at the last checkpoint (open and recently modified files), and files matching --lazy_hot
+hot_set () {
+    (
+        cat checkpoint/chkpt.hotset 2> /dev/null
+        if [ ${#lazy_hot[@]} -gt 0 ]
+        then
+            find . -path ./checkpoint -prune -o -type f -print | while read -r path
+            do
+                matches "${path#./}" "${lazy_hot[@]}" && echo "$path"
+            done
+        fi
+    ) | sort -u | while read -r path
+    do
+        [ -f "$path" ] && echo "$path"
+    done
+}
+
+# extract tarball with the files outside the hot set ($tarb.cold, see pack) while the job is restarted (in the
+# background); files are extracted in a staging dir on the same filesystem and hard-linked into place (files
+# created by the job in the meantime are kept), so the job never sees a partially extracted file
+# $restoremarker holds the pid of the extraction while it runs, it is removed when done, or contains 'failed'
+restore_cold () {
+    echo $BASHPID > "$restoremarker"
+    restore_start=`date +%%s`
+    staging="$%(CSUB_SCRATCH_NODE)s/.csub_restore/$jobname"
+    rm -Rf "$staging"
+    mkdir -p "$staging"
+    (
+        cd "$staging" && tar_extract "$tarb.cold" && cp -a -l -n . "$localdir/"
+    )
+    ec=$?
+    rm -Rf "$staging"
+    if [ $ec -gt 0 ]
+    then
+        myecho "Restoring job dir from $tarb.cold failed"
+        echo failed > "$restoremarker"
+        return 1
+    fi
+    rm -f "$restoremarker"
+    myecho "Restored rest of job dir from $tarb.cold in $((`date +%%s` - $restore_start)) seconds"
+}
+
+%(wait_for_restore)s
 pack () {
     fun=pack
     myecho
     myecho "begin $fun `date`"
-    ls -lrt
-    time tar -c $taropts -f $tarb . 2>&1
-    md5sum $tarb
-    if [ $? -gt 0 ]
+    pack_start=`date +%%s`
+    listing
+    layers=0
+    if [ -f "$tarb.layers" ]
     then
-    	"Packing failed. Cmd used: tar -c $taropts -f $tarb ."
-	   cleanuplocal
-	   endd
+        layers=`cat "$tarb.layers"`
     fi
+    if (( $dedup ))
+    then
+        ## content-addressed store: only chunks that are not in the store yet are written
+        store_pack
+        ec=$?
+    elif (( $incrmax )) && [ -f "$tarb.manifest" ] && [ $layers -lt $incrmax ]
+    then
+        ## incremental pack: only add files changed since previous pack as a new layer
+        layer=$(($layers + 1))
+        layerdir=`mktemp -d`
+        touch "$layerdir/changed"
+        make_manifest "$tarb.manifest" "$layerdir/changed" "$layerdir/deleted"
+        myecho "Packing layer $layer: `wc -l < $layerdir/changed` changed, `wc -l < $layerdir/deleted` removed files"
+        ## directories and symlinks are always included (no recursion), they are cheap
+        find . -mindepth 1 \( -type d -o -type l \) >> "$layerdir/changed"
+        tar_create "$tarb.layer.$layer" --no-recursion -T "$layerdir/changed"
+        ec=$?
+        cp "$layerdir/deleted" "$tarb.layer.$layer.deleted"
+        rm -Rf "$layerdir"
+        if [ $ec -eq 0 ]
+        then
+            echo $layer > "$tarb.layers"
+            pack_bytes=`stat -c %%s "$tarb.layer.$layer"`
+        fi
+    elif (( $lazy_restore ))
+    then
+        ## checkpoint images and hot set go in the tarball, all other files in a separate tarball
+        ## which the prologue extracts while the job is restarted (see restore_cold)
+        hotlist=`mktemp`
+        hot_set > "$hotlist"
+        myecho "Packing checkpoint and `wc -l < $hotlist` files needed right after restart separately"
+        tar_create "$tarb" ./checkpoint -T "$hotlist"
+        ec=$?
+        if [ $ec -eq 0 ]
+        then
+            tar_create "$tarb.cold" --no-wildcards --anchored --exclude=./checkpoint -X "$hotlist" .
+            ec=$?
+        fi
+        rm -f "$hotlist"
+        if [ $ec -eq 0 ]
+        then
+            pack_bytes=$((`stat -c %%s "$tarb"` + `stat -c %%s "$tarb.cold"`))
+        fi
+    else
+        ## full pack, also compacts previous layers
+        if (( $incrmax ))
+        then
+            make_manifest /dev/null /dev/null /dev/null
+        fi
+        tar_create "$tarb"
+        ec=$?
+        if [ $ec -eq 0 ]
+        then
+            rm -f "$tarb.layers" "$tarb".layer.* "$tarb".cold*
+            pack_bytes=`stat -c %%s "$tarb"`
+        fi
+    fi
+    if [ $ec -gt 0 ]
+    then
+        rm -f "$tarb.manifest.new"
+        myecho "Packing failed. Cmd used: tar -c $taropts -f $tarb ."
+        index_state failed
+        cleanuplocal
+        endd
+    fi
+    if [ -f "$tarb.manifest.new" ]
+    then
+        mv "$tarb.manifest.new" "$tarb.manifest"
+    fi
+    ## keep track of pack duration, see chkpt_budget in base
+    echo "$jobid pack $((`date +%%s` - $pack_start))" >> "$chkptdir/checkpoint/chkpt.durations"
+    metrics_event pack $pack_start $pack_bytes
     myecho "end $fun `date`"
     myecho
 }
@@ -104,19 +594,100 @@ unpack () {
     fun=unpack
     myecho
     myecho "begin $fun `date`"
-    ls -lrt
-    md5sum $tarb
-    time tar -x $taropts -f $tarb 2>&1
+    unpack_start=`date +%%s`
+    unpack_bytes=`stat -c %%s "$tarb"`
+    listing
+    tar_extract "$tarb"
     if [ $? -gt 0 ]
     then
-       "Unpacking failed. Cmd used: tar -x $taropts -f $tarb"
-	   cleanuplocal
-	   endd
+        myecho "Unpacking failed. Cmd used: tar -x $taropts -f $tarb"
+        cleanuplocal
+        endd
+    fi
+    ## rest of job dir (with --lazy_restore, see pack)
+    if [ -f "$tarb.cold" ]
+    then
+        unpack_bytes=$(($unpack_bytes + `stat -c %%s "$tarb.cold"`))
+        if (( $lazy_restore ))
+        then
+            ## marker is there before the prologue returns, base waits for it before the job dir is used
+            echo starting > "$restoremarker"
+            myecho "Restoring rest of job dir from $tarb.cold in the background"
+            restore_cold &
+        else
+            tar_extract "$tarb.cold"
+            if [ $? -gt 0 ]
+            then
+                myecho "Unpacking failed. Cmd used: tar -x $taropts -f $tarb.cold"
+                cleanuplocal
+                endd
+            fi
+        fi
     fi
+    if [ -f "$tarb.recipe" ]
+    then
+        unpack_bytes=$(($unpack_bytes + `du -sb "$storedir/refs/$jobname" | cut -f1`))
+        store_unpack
+        if [ $? -gt 0 ]
+        then
+            myecho "Unpacking from store $storedir failed (recipe $tarb.recipe)"
+            cleanuplocal
+            endd
+        fi
+    fi
+    ## apply incremental layers in order
+    if [ -f "$tarb.layers" ]
+    then
+        layers=`cat "$tarb.layers"`
+        for layer in `seq 1 $layers`
+        do
+            unpack_bytes=$(($unpack_bytes + `stat -c %%s "$tarb.layer.$layer"`))
+            tar_extract "$tarb.layer.$layer"
+            if [ $? -gt 0 ]
+            then
+                myecho "Unpacking layer $layer failed. Cmd used: tar -x $taropts -f $tarb.layer.$layer"
+                cleanuplocal
+                endd
+            fi
+            while read -r path
+            do
+                rm -f "$path"
+            done < "$tarb.layer.$layer.deleted"
+        done
+    fi
+    metrics_event unpack $unpack_start $unpack_bytes
     myecho "end $fun `date`"
     myecho
 }
 
+%(job_state)s
+# checkpoint count of job (0 if not started yet)
+chkpt_count () {
+    count=`state_get "$chkstate" chkpt`
+    echo ${count:-0}
+}
+
+# add state transition $1 to index of all csub jobs (see csub --status), for job id $2 (default: this job)
+index_state () {
+    local indexid=(${2:-$jobid})
+    echo "`date +%%s` $indexid $jobname $1 `chkpt_count`" >> "$%(CSUB_SCRATCH)s/chkpt/.index"
+}
+
+# job id of next job if job was resubmitted by base (see resubmit), empty otherwise
+next_jobid () {
+    awk -v name=$jobname '$3 == name { id = $2; state = $4 } END { if (state == "resubmitted") print id }' \
+        "$%(CSUB_SCRATCH)s/chkpt/.index" 2> /dev/null
+}
+
+# add timing event for phase $1 that started at $2 (and ends now), $3 is number of bytes moved (if any)
+# see metrics_event in base
+metrics_event () {
+    mkdir -p "$%(CSUB_SCRATCH)s/chkpt/.metrics"
+    printf '{"jobid": "%%s", "cycle": %%d, "phase": "%%s", "start": %%d, "end": %%d, "bytes": %%d}\n' \
+        $jobid `chkpt_count` $1 $2 `date +%%s` ${3:-0} \
+        >> "$%(CSUB_SCRATCH)s/chkpt/.metrics/$jobname.jsonl"
+}
+
 remove_dir () {
 	dir=$1
 	# this doesn't work on NFS, because (base script)job stdout and stderr are there
@@ -126,12 +697,9 @@ remove_dir () {
 	if [ $exit_code -gt 0 ]
 	then
 		myecho "Removing dir $dir failed (exit code: ${exit_code})."
-        myecho "We know this will fail on NFS, so retrying through $%(CSUB_O_HOST)s (different filesystem)."
-        ssh $%(CSUB_O_HOST)s rm -Rf $dir
-        if [ $? -gt 0 ]
-        then
-        	myecho "Removing dir $dir through $%(CSUB_O_HOST)s failed. Giving up."
-        fi
+        # don't hold up the node, queue it for csub --gc (from a node where the files are no longer open)
+        echo "`date +%%s` $jobid $dir" >> "$%(CSUB_SCRATCH)s/chkpt/.gc"
+        myecho "Queued dir $dir for removal by csub --gc."
 	fi
 }
 
@@ -175,46 +743,119 @@ chkptdir=$%(CSUB_SCRATCH)s/chkpt/$jobname
 
 ## destination tarball
 tarb="$chkptdir/checkpoint/job.localdir.tarball"
-## no compression, too slow
+## job state (see base), records whether tarball is complete
+chkstate="$chkptdir/checkpoint/chkpt.state"
+## compression is done through a (multi-threaded) codec, see codec_prog
 ## if adjusted, do so in csub too!!
-taropts=" -v -p"
+taropts=" -p"
+## 0: no listings, 1: size and checksum of archives, 2: full listings of directories and archives
+verbosity=%(pack_verbosity)d
+if [ $verbosity -ge 2 ]
+then
+    taropts="$taropts -v"
+fi
+tarcodec=%(tar_codec)s
+## maximum number of incremental layers on top of full tarball (0: always full pack)
+incrmax=%(incremental)d
+## content-addressed deduplicated store, shared by all jobs (chunks are not compressed)
+dedup=%(dedup)d
+storedir=$%(CSUB_SCRATCH)s/chkpt/.store
+## chunk size (bytes)
+storechunk=$((4 * 1024 * 1024))
+## pack checkpoint images and files needed right after a restart (hot set, see hot_set) separately, so the job
+## can be restarted before the rest of the job dir is extracted (see restore_cold)
+lazy_restore=%(lazy_restore)d
+## patterns of files that are always in the hot set: file name, or path relative to job dir if pattern contains a /
+lazy_hot=(%(lazy_hot)s)
+restoremarker="$localdir/checkpoint/chkpt.restoring"
+## automatic choice of node-local or shared job dir on first start (see choose_storage), recorded in $storagefile
+auto_storage=%(auto_storage)d
+## expected size (bytes) of work dir (including prestaged files) and of checkpoint images
+workdir_bytes=%(workdir_bytes)d
+image_estimate=%(image_estimate)d
+%(storage_space)s
+storagefile="$chkptdir/.storage"
+shared_workdir=0
+if (( $auto_storage )) && [ "`cat $storagefile 2> /dev/null`" == "shared" ]
+then
+    shared_workdir=1
+fi
 
 logg
 
 CURRENTDIR=`pwd`
 
+## initial job dir for array jobs (job name without array id)
+chkptdir_initial=`echo $chkptdir | sed 's/-[0-9]\\+$//g'`
+## node-local cache of initial tarball, shared by array tasks
+initcache="$%(CSUB_SCRATCH_NODE)s/.csub_initial/`basename $chkptdir_initial`"
+initial=0
+## node-local cache of prestaged files (see prestage), shared by jobs with the same source dir
+prestagecachekey=%(prestage_cachekey)s
+prestagecache="$%(CSUB_SCRATCH_NODE)s/.csub_prestage/$prestagecachekey"
+
 cd $localdir
 
 
 case $FLAVOUR in
     prologue)
-        if [ ! -f "${tarb}.ok" ]
+        if (( $auto_storage )) && [ ! -f "$storagefile" ]
+        then
+            choose_storage
+        fi
+        if (( $shared_workdir ))
+        then
+            ## base runs job in $chkptdir
+            myecho "Job dir on shared storage $chkptdir. No unpacking."
+            cleanuplocal
+            endd
+        fi
+
+        if [ "`state_get "$chkstate" tarball`" != "ok" ]
         then
-        	# if $tarb.ok was not found, maybe we're running the first ever prologue for an array job
-        	chkptdir_initial=`echo $chkptdir | sed 's/-[0-9]\\+$//g'`
+        	# if tarball is not complete, maybe we're running the first ever prologue for an array job
         	tarb_initial=`echo $tarb | sed 's@-[0-9]\\+/checkpoint@/checkpoint@g'`
-        	if [ ! -f $chkptdir_initial/checkpoint/chkpt.count ] && [ -f "${tarb_initial}.ok" ] && [ -f ${tarb_initial} ]
+        	if [ -z "`state_get "$chkstate" chkpt`" ] && [ "`state_get "$chkptdir_initial/checkpoint/chkpt.state" tarball`" == "ok" ] && [ -f ${tarb_initial} ]
         	then
         		tarb=$tarb_initial
+        		initial=1
         	else
             	## epilogue failed in intermediate tar (eg timeout)
-            	myecho "No tarball .ok file found. Won't start prologue."
+            	myecho "Tarball not complete according to job state $chkstate. Won't start prologue."
             	endd
             fi
         fi
 
 	   if [ -f "$tarb" ]
        then
-	       unpack
+           if (( $initial ))
+           then
+               unpack_initial
+           else
+	           unpack
+	       fi
 	   else
 	       myecho "No chkpt file $tarb found. No unpacking."
 	   fi
 	   ;;
     epilogue)
-        if [ ! -f "job.normal" ]
+        if (( $shared_workdir ))
+        then
+            cd "$chkptdir"
+        fi
+        jobend=`state_get "$chkstate" end`
+        ## job dir may still be restored in the background (see restore_cold), it can't be packed until it is complete
+        wait_for_restore "$restoremarker"
+        if [ $? -gt 0 ]
+        then
+            myecho "Job dir $localdir was not restored completely."
+            jobend=""
+        fi
+        if [ -z "$jobend" ]
         then
             ## abnormal job end, eg qdel
             myecho "Job completed. But no normal job end. Removing all local files"
+            index_state killed
         else
            mkdir -p "$chkptdir/checkpoint"
            if [ $? -gt 0 ]
@@ -223,24 +864,35 @@ case $FLAVOUR in
                endd
            fi
 
-    	   if [ ! -f "job.complete" ]
+    	   if [ "$jobend" != "complete" ]
 	       then
-	           ## remove tarball ok file
-	           rm -f "$tarb.ok"
-	           pack
-               ## set tarball ok file
-	           touch "$tarb.ok"
+	           if (( $shared_workdir ))
+	           then
+	               myecho "Job dir on shared storage $chkptdir. No packing."
+	           else
+	               ## tarball is not complete while packing
+	               state_set "$chkstate" tarball=
+	               pack
+	               state_set "$chkstate" tarball=ok
+	               ## checkpoint images in shared storage are superseded by the ones in the tarball
+	               if [ "`readlink checkpoint/images`" == "images.local" ]
+	               then
+	                   rm -f "$chkptdir/checkpoint/images/"*.dmtcp
+	               fi
+	           fi
+	           ## keep job id of next job (if any) as last job id of the job in the index
+	           index_state checkpointed `next_jobid`
 	       else
 	           myecho "Job completed. No packing."
 	           if (( $cleanup_chkpt ))
 	           then
 		           myecho "Removing chkptdir $chkptdir"
 		           remove_dir "$chkptdir"
+		           store_release "$storedir/refs/$jobname"
 
             	   # last array job should try and remove initial job directory
                	   # this directory contains all info on checkpointing of different array jobs
 
-	               chkptdir_initial=`echo $chkptdir | sed 's/-[0-9]\\+$//g'`
     	           dir=`dirname $chkptdir_initial`
         	       base=`basename $chkptdir_initial`
             	   ls "$dir" | grep "^${base}-[0-9]\+$" >& /dev/null
@@ -248,13 +900,16 @@ case $FLAVOUR in
     	           then
         	       		remove_dir ${chkptdir_initial}
             	   fi
-               else
+               elif (( ! $shared_workdir ))
+               then
                		# 	copy back stdout/stderr of job into chkpt subdir (useful for debugging)
                		cp "$localdir/${jobname}.out" "$localdir/${jobname}.err" "$chkptdir"
                fi
 	       fi
 	   fi
 	   cleanuplocal
+	   cleanup_initial_cache
+	   cleanup_prestage_cache
 
 	   ;;
 esac
@@ -0,0 +1,264 @@
+#!/bin/bash
+
+# Benchmark for checkpoint overhead of csub
+#
+# Runs the full csub -> base -> epilogue lifecycle locally, using stand-in qsub and DMTCP commands (see bench/),
+# for a set of synthetic workloads. Reports overhead per checkpoint/restart cycle, bytes written to scratch
+# and wall-clock time lost (compared to running the workload without checkpointing) as JSON, one line per workload.
+#
+# Usage: bench.sh [-o <output file>] [<workload> ...]
+# where a workload is the name of one of the workloads below, or a specification of the form
+#     <name>:<work dir size (MB)>:<number of files>:<image size (MB)>:<array width>[:<extra csub options>]
+#
+# Environment variables:
+#   CSUB              csub command to benchmark [default: ./csub, run ./makecsub.py first]
+#   BENCH_DIR         directory for scratch, node local dirs and stand-in state [default: /tmp/$USER/bench]
+#   BENCH_STEPS       runtime of every workload in seconds [default: 60]
+#   BENCH_JOB_TIME    --job_time passed to csub [default: 0:0:20]
+#   BENCH_CHKPT_TIME  --chkpt_time passed to csub [default: 0:0:30]
+#   BENCH_TIMEOUT     time (seconds) after which a workload is aborted [default: 900]
+#   BENCH_RANKS       number of processes (ranks) of workloads with --mpi, all on the local node [default: 4]
+#   BENCH_QSUB_QUEUE_WAIT  time (seconds) a job waits in the queue after it was submitted (see bench/qsub) [default: 0]
+
+testdir=$(cd `dirname $0` && pwd)
+
+workloads="
+small:1:10:1:1
+many_files:16:2000:1:1
+large_workdir:256:32:1:1
+large_image:1:10:256:1
+array:1:10:1:4
+compressed:256:32:64:1:--compress=gzip
+incremental:256:32:1:1:--incremental=4
+dedup:256:32:1:1:--dedup
+mpi:1:10:1:1:--mpi
+prequeue:1:10:1:1:--prequeue
+profile:1:10:1:1:--profile=0:0:5
+lazy_restore:256:32:1:1:--lazy_restore
+signal:1:10:1:1:--chkpt_signal=USR2 --chkpt_signal_time=0:0:40
+"
+
+output=/dev/stdout
+if [ "$1" == "-o" ]; then
+    output=$2
+    shift 2
+fi
+
+csub=${CSUB:-./csub}
+benchdir=${BENCH_DIR:-/tmp/$USER/bench}
+steps=${BENCH_STEPS:-60}
+job_time=${BENCH_JOB_TIME:-0:0:20}
+chkpt_time=${BENCH_CHKPT_TIME:-0:0:30}
+job_time_secs=`echo $job_time | awk -F: '{ print ($1 * 60 + $2) * 60 + $3 }'`
+timeout_secs=${BENCH_TIMEOUT:-900}
+ranks=${BENCH_RANKS:-4}
+
+if [ ! -x "$csub" ]; then
+    echo "ERROR: csub command $csub not found (run ./makecsub.py first, or set \$CSUB)" >&2
+    exit 1
+fi
+csub=$(cd `dirname $csub` && pwd)/`basename $csub`
+
+# stand-in commands take precedence
+export PATH=$testdir/bench:$PATH
+
+# kill all jobs and processes that are still around for current workload
+cleanup () {
+    for pidfile in `ls $BENCH_QSUB_STATE/*.pid $FAKE_DMTCP_STATE/*/procs/*/pid 2> /dev/null`; do
+        kill -9 -- -`cat $pidfile` 2> /dev/null
+    done
+}
+trap 'cleanup; exit 1' INT TERM
+
+# run workload $1
+run_workload () {
+    IFS=: read name workdir_mb files image_mb width csub_opts <<< "$1"
+
+    dir=$benchdir/$name
+    rm -Rf $dir
+    mkdir -p $dir/src $dir/scratch $dir/node
+
+    export VSC_SCRATCH=$dir/scratch
+    export VSC_SCRATCH_NODE=$dir/node
+    export BENCH_QSUB_STATE=$dir/qsub
+    export FAKE_DMTCP_STATE=$dir/dmtcp
+    export FAKE_DMTCP_IMAGE_MB=$image_mb
+
+    # synthetic work dir: files of random data, copied to node local dir by prestage
+    mkdir -p $dir/src/data
+    filesize=$(($workdir_mb * 1024 * 1024 / $files))
+    for i in `seq 1 $files`; do
+        head -c $filesize /dev/urandom > $dir/src/data/file.$i
+    done
+
+    # synthetic workload: $steps steps of 1 second, state is saved in checkpoint images by fake DMTCP
+    cat > $dir/src/work.sh << EOF
+#!/bin/bash
+i=\`cat .fake_dmtcp_state 2> /dev/null || echo 0\`
+while [ \$i -lt $steps ]; do
+    echo "\$i \`date\`"
+    sleep 1
+    i=\$((\$i + 1))
+    echo \$i > .fake_dmtcp_state
+done
+EOF
+    chmod +x $dir/src/work.sh
+
+    if [[ " $csub_opts " =~ " --mpi " ]]; then
+        # $ranks processes that join the DMTCP session (like ranks started by mpirun), each with its own state file:
+        # rank 0 starts the others (not after a restart, they are restarted from their own images)
+        # and waits until all of them are done
+        mv $dir/src/work.sh $dir/src/rank.sh
+        sed -i 's/\.fake_dmtcp_state/$FAKE_DMTCP_STATEFILE/g' $dir/src/rank.sh
+        cat > $dir/src/work.sh << EOF
+#!/bin/bash
+if [ ! -f .fake_dmtcp_state ]; then
+    for r in \`seq 1 $(($ranks - 1))\`; do
+        FAKE_DMTCP_STATEFILE=.fake_dmtcp_state.\$r dmtcp_launch --join-coordinator bash -c "./rank.sh > rank.\$r.out" &
+    done
+fi
+./rank.sh
+for r in \`seq 1 $(($ranks - 1))\`; do
+    while [ "\`cat .fake_dmtcp_state.\$r 2> /dev/null\`" != "$steps" ]; do
+        sleep 1
+    done
+done
+EOF
+        chmod +x $dir/src/work.sh
+    fi
+
+    arrayopt=""
+    if [ $width -gt 1 ]; then
+        arrayopt="-t 1-$width"
+    fi
+
+    echo "Running workload $name (work dir ${workdir_mb}MB in $files files, image ${image_mb}MB, array width $width, options: ${csub_opts:-none})" >&2
+    start=`date +%s`
+    out=`$csub -s $dir/src/work.sh --pre --job_time=$job_time --chkpt_time=$chkpt_time $arrayopt $csub_opts 2>&1`
+    ec=$?
+    jobname=`echo "$out" | sed -n 's/^Job with name \(.*\) succesfully submitted.*/\1/p'`
+    if [ $ec -ne 0 ] || [ -z "$jobname" ]; then
+        echo "ERROR: csub failed for workload $name: $out" >&2
+        return 1
+    fi
+
+    # wait until there are no more jobs queued or running
+    completed=1
+    while true; do
+        sleep 2
+        if [ $((`date +%s` - $start)) -gt $timeout_secs ]; then
+            echo "ERROR: workload $name did not finish within $timeout_secs seconds" >&2
+            cleanup
+            completed=0
+            break
+        fi
+        running=0
+        for job in `ls $BENCH_QSUB_STATE/*.job`; do
+            if [ ! -f ${job%.job}.done ]; then
+                running=1
+            fi
+        done
+        if [ $running -eq 0 ]; then
+            break
+        fi
+    done
+    end=`date +%s`
+
+    # every task should be complete according to the job index
+    tasks=$jobname
+    if [ $width -gt 1 ]; then
+        tasks=`seq -f "$jobname-%g" 1 $width`
+    fi
+    for task in $tasks; do
+        state=`awk -v name=$task '$3 == name { state = $4 } END { print state }' $VSC_SCRATCH/chkpt/.index`
+        if [ "$state" != "complete" ]; then
+            echo "ERROR: task $task of workload $name ended in state '$state'" >&2
+            completed=0
+        fi
+        # with --chkpt_signal, the signal should trigger the first checkpoint before the job time is used up
+        if [[ " $csub_opts " =~ " --chkpt_signal=" ]]; then
+            secs=`awk -v name=$task '$3 == name && $4 == "running" && !start { start = $1 }
+                $3 == name && $4 == "resubmitted" && !end { end = $1 } END { print (end ? end - start : -1) }' \
+                $VSC_SCRATCH/chkpt/.index`
+            if [ $secs -lt 0 ] || [ $secs -ge $job_time_secs ]; then
+                echo "ERROR: task $task of workload $name was not checkpointed on the signal" >&2
+                completed=0
+            fi
+        fi
+    done
+
+    # no processes may be left behind, e.g. in a session of their own (see --chkpt_signal)
+    for pidfile in `ls $FAKE_DMTCP_STATE/*/procs/*/pid 2> /dev/null`; do
+        if kill -0 `cat $pidfile` 2> /dev/null; then
+            echo "ERROR: process `cat $pidfile` of workload $name is still running" >&2
+            completed=0
+        fi
+    done
+
+    shared=0
+    if [[ " $csub_opts " =~ " --shared " ]] || [[ " $csub_opts " =~ " --mpi " ]]; then
+        shared=1
+    fi
+
+    $csub --report=$jobname --json | python -c "
+import glob, json, sys
+
+jobs = json.load(sys.stdin)
+
+# bytes written to scratch: packed checkpoints, or checkpoint images written directly to scratch (--shared, --mpi)
+scratch_phases = $shared and ['makechkpt'] or ['pack']
+scratch_bytes = {}
+for fn in glob.glob('$VSC_SCRATCH/chkpt/.metrics/$jobname.jsonl') + glob.glob('$VSC_SCRATCH/chkpt/.metrics/$jobname-[0-9]*.jsonl'):
+    for line in open(fn).readlines():
+        event = json.loads(line)
+        if event['phase'] in scratch_phases:
+            scratch_bytes[event['jobid']] = scratch_bytes.get(event['jobid'], 0) + event['bytes']
+
+for job in jobs:
+    job['scratch_bytes'] = scratch_bytes.get(job['jobid'], 0)
+    job['lost'] = job['overhead'] + (job['queue_wait'] or 0)
+
+result = {
+    'workload': '$name',
+    'workdir_mb': $workdir_mb,
+    'files': $files,
+    'image_mb': $image_mb,
+    'array_width': $width,
+    'csub_options': '$csub_opts',
+    'completed': bool($completed),
+    'steps': $steps,
+    'cycles': len(jobs),
+    'elapsed': $end - $start,
+    # wall-clock time lost per task: time to solution minus time without checkpointing
+    'lost': $end - $start - $steps,
+    'overhead': sum([x['overhead'] for x in jobs]),
+    'queue_wait': sum([x['queue_wait'] or 0 for x in jobs]),
+    'scratch_bytes': sum([x['scratch_bytes'] for x in jobs]),
+    'jobs': jobs,
+}
+sys.stdout.write(json.dumps(result) + '\n')
+sys.stderr.write('%(workload)s: %(cycles)d cycles, elapsed %(elapsed)ds, lost %(lost)ds, overhead %(overhead)ds, '
+                 'queue wait %(queue_wait)ds, %(scratch_bytes)d bytes written to scratch\n' % result)
+" >> $output
+
+    cleanup
+    return $((1 - $completed))
+}
+
+if [ $# -eq 0 ]; then
+    # one workload per line (extra csub options may contain spaces)
+    IFS=$'\n'
+    set -- $workloads
+    unset IFS
+fi
+
+ec=0
+for workload in "$@"; do
+    spec=`echo "$workloads" | grep "^$workload:"`
+    if [ -z "$spec" ]; then
+        spec=$workload
+    fi
+    run_workload "$spec" || ec=1
+done
+
+exit $ec
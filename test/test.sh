@@ -16,17 +16,17 @@ if [ $qsub != $testdir/qsub ]; then
 fi
 
 # submit checkpointed 'job'
-./csub --shared -s $testdir/count.sh --job_time=0:0:20 --no_cleanup_chkpt
+./csub --shared -s $testdir/count.sh --job_time=0:1:0 --no_cleanup_chkpt
 ec=$?
 if [ $ec -ne 0 ]; then
     echo "ERROR: csub failed to run" >&2
     exit $ec
 fi
 
-# wait until job.complete file is created
-# count.sh needs 150s to complete, csub only checks once a minute => 2 checkpoints expected
+# wait until job is complete according to job state
+# count.sh needs 150s to complete, job time is 1 minute => 2 checkpoints expected
 timeout_secs=240
-timeout $timeout_secs bash -c -- "while [ ! -f /tmp/$USER/chkpt/*/job.complete ]; do date; sleep 10; done"
+timeout $timeout_secs bash -c -- "while ! grep -q '^end=complete$' /tmp/$USER/chkpt/*/checkpoint/chkpt.state 2> /dev/null; do date; sleep 10; done"
 ec=$?
 # dump debug info if timeout was triggered
 if [ $ec -ne 0 ]; then
@@ -36,22 +36,23 @@ if [ $ec -ne 0 ]; then
     cat /tmp/$USER/chkpt/*/count.sh.*.[0-9A-Za-z][0-9A-Za-z].out
     echo "stderr"
     cat /tmp/$USER/chkpt/*/count.sh.*.base.err
-    echo "ERROR: job.complete file was not found after waiting $timeout_secs seconds..." >&2
+    echo "ERROR: job was not complete after waiting $timeout_secs seconds..." >&2
     exit 1
 fi
 
-ls -l /tmp/$USER/chkpt/*/job.normal /tmp/$USER/chkpt/*/job.complete
+cat /tmp/$USER/chkpt/*/checkpoint/chkpt.state
+grep '^version=1$' /tmp/$USER/chkpt/*/checkpoint/chkpt.state
 if [ $? -ne 0 ]; then
-    echo "ERROR: Expected job.normal and job.complete files not found in /tmp/$USER/chkpt/*" >&2
+    echo "ERROR: Unexpected version of job state in /tmp/$USER/chkpt/*/checkpoint/chkpt.state" >&2
     exit 1
 fi
 
-start_count=`cat /tmp/$USER/chkpt/*/checkpoint/start.count`
+start_count=`sed -n 's/^starts=//p' /tmp/$USER/chkpt/*/checkpoint/chkpt.state`
 if [ ${start_count:-1} -ne 0 ]; then
     echo "ERROR: Unexpected start count (should be 0): $start_count" >&2
     exit 1
 fi
-chkpt_count=`cat /tmp/$USER/chkpt/*/checkpoint/chkpt.count`
+chkpt_count=`sed -n 's/^chkpt=//p' /tmp/$USER/chkpt/*/checkpoint/chkpt.state`
 if [ ${chkpt_count:-1} -ne 2 ]; then
     echo "ERROR: Unexpected chkpt count (should be 2): $chkpt_count" >&2
     exit 1